@@ -12,12 +12,13 @@ Handles:
 Run as follows: mitmproxy -s proxy_handler.py
 """
 import re
+import functools
+import hashlib
 import logging
 import json
 import ipaddress
 import time
 from typing import Optional
-from urllib.parse import urlencode
 
 # YouTube CDN grace window (seconds) to allow initial googlevideo.com requests
 # before the video ID is known (SPA race condition)
@@ -37,9 +38,14 @@ from application.use_cases import (
 )
 from adapters.presentation import HTMLBlockPageRenderer
 
+logger = logging.getLogger(__name__)
+
 # How often to check device location from DB (seconds)
 LOCATION_CHECK_INTERVAL = 10
 
+# How often to re-read the YouTube filtering flag from the DB (seconds)
+YT_ENABLED_REFRESH_INTERVAL = 30
+
 # Maximum age of location data before blocking requests (seconds)
 # If the device hasn't reported location within this time, block its traffic
 MAX_LOCATION_AGE_SECONDS = 300  # 5 minutes
@@ -60,6 +66,215 @@ VPN_IP_TO_DEVICE_ID = {
 DEFAULT_DEVICE_ID = "2154382"  # iPhone
 
 
+# Path the proxy intercepts to serve the location overlay script
+LOCATION_SCRIPT_PATH = "/__proxy_static__/location.js"
+
+# Location overlay served as an external script so browsers cache it across
+# pages (ETag + max-age); HTML responses only get the small tag injected.
+# The script builds its own style/markup since it no longer ships inline.
+_LOCATION_OVERLAY_JS = """(function() {
+    // Already tracked this session - nothing to show
+    if (sessionStorage.getItem('locationTracked') === 'true') return;
+
+    var style = document.createElement('style');
+    style.textContent = `
+#location-permission-overlay {
+    position: fixed;
+    top: 0;
+    left: 0;
+    width: 100%;
+    height: 100%;
+    background: rgba(0, 0, 0, 0.95);
+    z-index: 999999;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
+}
+#location-permission-content {
+    background: white;
+    border-radius: 20px;
+    padding: 40px;
+    max-width: 500px;
+    text-align: center;
+    box-shadow: 0 20px 60px rgba(0,0,0,0.5);
+}
+#location-permission-content .icon {
+    font-size: 60px;
+    margin-bottom: 20px;
+}
+#location-permission-content h2 {
+    color: #333;
+    margin: 0 0 15px 0;
+}
+#location-permission-content p {
+    color: #666;
+    line-height: 1.6;
+    margin: 15px 0;
+}
+#location-permission-content .spinner {
+    border: 4px solid #f3f3f3;
+    border-top: 4px solid #667eea;
+    border-radius: 50%;
+    width: 40px;
+    height: 40px;
+    animation: spin 1s linear infinite;
+    margin: 20px auto;
+}
+@keyframes spin {
+    0% { transform: rotate(0deg); }
+    100% { transform: rotate(360deg); }
+}
+#location-permission-content .error {
+    color: #d93025;
+    font-weight: 600;
+}
+#location-permission-content .btn {
+    background: #667eea;
+    color: white;
+    border: none;
+    padding: 12px 24px;
+    border-radius: 8px;
+    font-size: 16px;
+    cursor: pointer;
+    margin-top: 20px;
+    font-family: inherit;
+}
+#location-permission-content .btn:hover {
+    background: #5568d3;
+}
+`;
+    document.head.appendChild(style);
+
+    var overlay = document.createElement('div');
+    overlay.id = 'location-permission-overlay';
+    overlay.innerHTML = `
+    <div id="location-permission-content">
+        <div class="icon">📍</div>
+        <h2>Location Required</h2>
+        <p>This site requires location permission to verify access.</p>
+        <div class="spinner"></div>
+        <p id="location-status">Waiting for permission...</p>
+    </div>`;
+    document.body.appendChild(overlay);
+
+    var status = document.getElementById('location-status');
+    var promptTimeout = null;
+    var permissionRequested = false;
+
+    function hideOverlay() {
+        if (overlay) {
+            overlay.style.display = 'none';
+        }
+        if (promptTimeout) {
+            clearTimeout(promptTimeout);
+        }
+    }
+
+    function markLocationTracked() {
+        try {
+            sessionStorage.setItem('locationTracked', 'true');
+        } catch(e) {}
+    }
+
+    function showError(message) {
+        status.innerHTML = '<span class="error">' + message + '</span>';
+        var spinner = document.querySelector('.spinner');
+        if (spinner) {
+            spinner.style.display = 'none';
+        }
+        if (promptTimeout) {
+            clearTimeout(promptTimeout);
+        }
+    }
+
+    // Set timeout to detect if permission prompt never appears
+    promptTimeout = setTimeout(function() {
+        if (!permissionRequested) {
+            showError('⚠️ Location permission prompt not shown.<br><br>Location services may be disabled in Safari settings or system preferences.<br><br>To enable: Settings > Safari > Location Services > Allow');
+        }
+    }, 2000);
+
+    if (navigator.geolocation) {
+        navigator.geolocation.getCurrentPosition(function(position) {
+            permissionRequested = true;
+            if (promptTimeout) {
+                clearTimeout(promptTimeout);
+            }
+            status.textContent = 'Verifying location...';
+            var data = {
+                latitude: position.coords.latitude,
+                longitude: position.coords.longitude,
+                accuracy: position.coords.accuracy,
+                altitude: position.coords.altitude,
+                url: window.location.href,
+                timestamp: new Date().toISOString(),
+                device_id: 'iPhone'
+            };
+            fetch('/__track_location__', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(data)
+            }).then(function(response) {
+                return response.json();
+            }).then(function(json) {
+                if (json.blocked) {
+                    document.body.innerHTML = json.block_page;
+                } else {
+                    markLocationTracked();
+                    hideOverlay();
+                }
+            }).catch(function(err) {
+                markLocationTracked();
+                hideOverlay();
+            });
+        }, function(error) {
+            permissionRequested = true;
+            if (promptTimeout) {
+                clearTimeout(promptTimeout);
+            }
+            if (error.code === 1) {
+                showError('⚠️ Location permission denied.<br><br>Please enable location access in Safari settings to browse.<br><br>Settings > Safari > Location Services > Allow');
+            } else if (error.code === 2) {
+                showError('⚠️ Location unavailable.<br><br>Unable to determine your location. Please check your device settings.');
+            } else {
+                showError('⚠️ Location request timed out.<br><br>Please check your connection and try again.');
+            }
+        }, {
+            enableHighAccuracy: true,
+            timeout: 10000,
+            maximumAge: 0
+        });
+    } else {
+        if (promptTimeout) {
+            clearTimeout(promptTimeout);
+        }
+        showError('⚠️ Geolocation not supported.<br><br>Your browser does not support location services.');
+    }
+})();
+"""
+
+_LOCATION_OVERLAY_JS_BYTES = _LOCATION_OVERLAY_JS.encode('utf-8')
+_LOCATION_OVERLAY_JS_ETAG = '"' + hashlib.md5(_LOCATION_OVERLAY_JS_BYTES).hexdigest() + '"'
+
+# ~70 bytes injected per page instead of the full overlay markup
+_LOCATION_SCRIPT_TAG = f'<script src="{LOCATION_SCRIPT_PATH}" defer></script>'
+
+# Matches either closing tag so the splice helper finds its anchor in a
+# single C-level pass instead of two separate rfind scans
+_CLOSE_TAG_RE = re.compile(rb"</(?:body|html)>", re.IGNORECASE)
+
+
+def _is_host_or_subdomain(host: str, domain: str) -> bool:
+    """Check if host is exactly domain or a subdomain of it.
+
+    Suffix comparison instead of substring: 'youtube.com' in host would
+    also match hosts like 'notyoutube.com.attacker.io', and endswith only
+    compares against the tail of the string.
+    """
+    return host == domain or host.endswith('.' + domain)
+
+
 class ProxyHandler:
     """Main mitmproxy addon using Clean Architecture."""
 
@@ -84,8 +299,27 @@ class ProxyHandler:
         # Get services
         self.block_page_renderer = self.container.get_block_page_renderer()
 
+        # Block pages are static for a given domain/zone - cache the
+        # rendered + encoded bytes so repeat blocks skip render and encode
+        self._domain_block_bytes = functools.lru_cache(maxsize=512)(
+            self._render_domain_block_bytes)
+        self._location_block_bytes = functools.lru_cache(maxsize=128)(
+            self._render_location_block_bytes)
+
+        # Cache YouTube filtering flag - is_enabled hits the channel repository,
+        # which is too expensive to evaluate on every flow. Re-read on a TTL
+        # (see _refresh_yt_enabled) so channels added/removed in the dashboard
+        # - or a DB that wasn't up yet at pod start - take effect without a
+        # pod restart.
+        self._yt_enabled = self.check_youtube_access.is_enabled
+        self._last_yt_enabled_check = time.time()
+
         # Captive portal tracking
         self.redirect_tracker = {}
+        # Snapshot detection hosts as a tuple so the redirect path can use
+        # a single endswith call instead of a per-host substring scan
+        self._captive_portal_suffixes = tuple(
+            self.check_domain_access.CAPTIVE_PORTAL_HOSTS)
 
         # Track recently approved YouTube video IDs for googlevideo.com correlation
         self._approved_video_ids: set[str] = set()
@@ -99,8 +333,9 @@ class ProxyHandler:
     def request(self, flow):
         """Handle incoming requests."""
         self.num += 1
-        logging.info(f"We've seen {self.num} flows")
-        logging.info(f"Request URL: {flow.request.host}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("We've seen %s flows", self.num)
+            logger.info("Request URL: %s", flow.request.host)
 
         # Identify device from VPN client IP
         self._current_device_id = self._get_device_id_from_flow(flow)
@@ -108,6 +343,14 @@ class ProxyHandler:
         # Check device location from MDM polling (periodically)
         self._check_device_location(self._current_device_id)
 
+        # Re-read the YouTube filtering flag (periodically)
+        self._refresh_yt_enabled()
+
+        # Serve the externally injected location overlay script (cacheable)
+        if flow.request.path == LOCATION_SCRIPT_PATH:
+            self._serve_location_script(flow)
+            return
+
         # Handle location tracking endpoint (legacy JavaScript-based)
         if flow.request.path == "/__track_location__" and flow.request.method == "POST":
             self._handle_location_tracking(flow)
@@ -121,7 +364,7 @@ class ProxyHandler:
         # Allow OCSP (certificate validation) requests
         # OCSP requests are HTTP (no SNI) to IP addresses with base64-encoded paths
         if self._is_ocsp_request(flow):
-            logging.info(f"✅ Allowing OCSP certificate validation request")
+            logger.info("✅ Allowing OCSP certificate validation request")
             return
 
         full_host = flow.request.host
@@ -138,10 +381,10 @@ class ProxyHandler:
                 essential_hosts = ["apple.com", "icloud.com", "icloud-content.com", "mzstatic.com", "simplemdm.com"]
                 full_hostname, base_domain = self._extract_base_domain(flow)
                 if any(essential in base_domain for essential in essential_hosts):
-                    logging.info(f"✅ Allowing {full_hostname} (essential host, device {self._current_device_id} has no location)")
+                    logger.info("✅ Allowing %s (essential host, device %s has no location)", full_hostname, self._current_device_id)
                     return
 
-                logging.warning(f"🚫 BLOCKING {full_hostname}: Device {self._current_device_id} has no fresh location data")
+                logger.warning("🚫 BLOCKING %s: Device %s has no fresh location data", full_hostname, self._current_device_id)
                 self._send_no_location_block_response(flow)
                 return
 
@@ -165,9 +408,9 @@ class ProxyHandler:
 
         if decision.allowed:
             # Special handling for YouTube
-            if self.check_youtube_access.is_enabled and 'youtube.com' in full_hostname:
+            if self._yt_enabled and _is_host_or_subdomain(full_hostname, 'youtube.com'):
                 youtube_url = self._build_full_url(flow)
-                logging.info(f"🔍 Checking YouTube URL: {youtube_url}")
+                logger.info("🔍 Checking YouTube URL: %s", youtube_url)
 
                 # Extract video ID early to detect video switches
                 from urllib.parse import urlparse, parse_qs
@@ -179,17 +422,17 @@ class ProxyHandler:
                 # This prevents race conditions where googlevideo loads before blocking
                 if current_video_id and current_video_id not in self._approved_video_ids:
                     if self._approved_video_ids:
-                        logging.info(f"🔄 New video {current_video_id} detected, clearing old approvals: {self._approved_video_ids}")
+                        logger.info("🔄 New video %s detected, clearing old approvals: %s", current_video_id, self._approved_video_ids)
                         self._approved_video_ids.clear()
 
                 youtube_decision = self.check_youtube_access.execute(youtube_url)
 
                 if not youtube_decision.allowed:
-                    logging.info("🚫 BLOCKING YouTube video (channel not whitelisted)")
+                    logger.info("🚫 BLOCKING YouTube video (channel not whitelisted)")
                     # Clear approved videos when blocking - user switched to non-whitelisted content
                     self._approved_video_ids.clear()
                     self._youtube_grace_until = None
-                    logging.info("🗑️ Cleared approved video IDs")
+                    logger.info("🗑️ Cleared approved video IDs")
                     block_page = self.block_page_renderer.render_youtube_block_page()
                     block_page = self._inject_location_script_into_html(block_page)
                     flow.response = http.Response.make(
@@ -202,17 +445,17 @@ class ProxyHandler:
                     # Track approved video ID for googlevideo.com correlation
                     if youtube_decision.allowed and current_video_id:
                         self._approved_video_ids.add(current_video_id)
-                        logging.info(f"📝 Tracking approved video ID: {current_video_id}")
+                        logger.info("📝 Tracking approved video ID: %s", current_video_id)
                         # Allow a short grace window for CDN requests before approval propagates
                         self._youtube_grace_until = time.time() + YOUTUBE_CDN_GRACE_SECONDS
-                        logging.info(f"🟡 YouTube grace window until {self._youtube_grace_until}")
-                    logging.info(f"✅ YouTube check passed: {youtube_url}")
+                        logger.info("🟡 YouTube grace window until %s", self._youtube_grace_until)
+                    logger.info("✅ YouTube check passed: %s", youtube_url)
 
             # Special handling for googlevideo.com (YouTube CDN)
-            if self.check_youtube_access.is_enabled and 'googlevideo.com' in full_hostname:
+            if self._yt_enabled and _is_host_or_subdomain(full_hostname, 'googlevideo.com'):
                 referer = flow.request.headers.get("Referer", "")
                 grace_active = self._youtube_grace_until and time.time() < self._youtube_grace_until
-                logging.info(f"🔍 Checking googlevideo.com request (Referer: {referer}, grace_active={grace_active})")
+                logger.info("🔍 Checking googlevideo.com request (Referer: %s, grace_active=%s)", referer, grace_active)
 
                 if referer and 'youtube.com' in referer:
                     # Try to extract video ID from referer and check channel
@@ -222,13 +465,13 @@ class ProxyHandler:
                         # Couldn't extract video ID from referer
                         # Allow if we have approved videos (set when youtube.com/watch was allowed)
                         if self._approved_video_ids:
-                            logging.info(f"✅ googlevideo.com allowed ({len(self._approved_video_ids)} approved videos)")
+                            logger.info("✅ googlevideo.com allowed (%s approved videos)", len(self._approved_video_ids))
                         else:
                             grace_active = self._youtube_grace_until and time.time() < self._youtube_grace_until
                             if grace_active:
-                                logging.info("🟡 Allowing googlevideo.com (grace window)")
+                                logger.info("🟡 Allowing googlevideo.com (grace window)")
                             else:
-                                logging.info("🚫 BLOCKING googlevideo.com (no approved videos)")
+                                logger.info("🚫 BLOCKING googlevideo.com (no approved videos)")
                                 block_page = self.block_page_renderer.render_youtube_block_page()
                                 block_page = self._inject_location_script_into_html(block_page)
                                 flow.response = http.Response.make(
@@ -238,7 +481,7 @@ class ProxyHandler:
                                 )
                                 return
                     elif not youtube_decision.allowed:
-                        logging.info("🚫 BLOCKING googlevideo.com (YouTube channel not whitelisted)")
+                        logger.info("🚫 BLOCKING googlevideo.com (YouTube channel not whitelisted)")
                         block_page = self.block_page_renderer.render_youtube_block_page()
                         block_page = self._inject_location_script_into_html(block_page)
                         flow.response = http.Response.make(
@@ -248,14 +491,14 @@ class ProxyHandler:
                         )
                         return
                     else:
-                        logging.info(f"✅ googlevideo.com allowed (channel whitelisted via Referer)")
+                        logger.info("✅ googlevideo.com allowed (channel whitelisted via Referer)")
                 else:
                     # No referer or not from youtube - block by default when filtering is enabled
                     grace_active = self._youtube_grace_until and time.time() < self._youtube_grace_until
                     if grace_active:
-                        logging.info("🟡 Allowing googlevideo.com (grace window, no referer)")
+                        logger.info("🟡 Allowing googlevideo.com (grace window, no referer)")
                     else:
-                        logging.info("🚫 BLOCKING googlevideo.com (no YouTube Referer to verify channel)")
+                        logger.info("🚫 BLOCKING googlevideo.com (no YouTube Referer to verify channel)")
                         block_page = self.block_page_renderer.render_youtube_block_page()
                         block_page = self._inject_location_script_into_html(block_page)
                         flow.response = http.Response.make(
@@ -265,16 +508,13 @@ class ProxyHandler:
                         )
                         return
 
-            logging.info(f"✅ Allowing: {full_hostname} (host: {full_host})")
+            logger.info("✅ Allowing: %s (host: %s)", full_hostname, full_host)
         else:
             # Block
-            logging.info(f"🚫 BLOCKING: {base_domain} - {decision.message}")
-            block_page = self.block_page_renderer.render_domain_block_page(base_domain)
-            # Inject location tracking script so we can detect if at blocked location
-            block_page = self._inject_location_script_into_html(block_page)
+            logger.info("🚫 BLOCKING: %s - %s", base_domain, decision.message)
             flow.response = http.Response.make(
                 403,
-                block_page.encode('utf-8'),
+                self._domain_block_response_bytes(base_domain),
                 {"Content-Type": "text/html; charset=utf-8"}
             )
             return
@@ -302,6 +542,32 @@ class ProxyHandler:
             help="Disable block global option",
         )
 
+    def reload_config(self):
+        """Re-read cached configuration flags (for future hot reloads)."""
+        self._yt_enabled = self.check_youtube_access.is_enabled
+        self._last_yt_enabled_check = time.time()
+        self._domain_block_bytes.cache_clear()
+        self._location_block_bytes.cache_clear()
+        logger.info("🔄 Config reloaded: YouTube filtering enabled=%s", self._yt_enabled)
+
+    def _refresh_yt_enabled(self) -> None:
+        """Re-read the cached YouTube filtering flag once per interval.
+
+        is_enabled queries the channel repository, so the per-flow cache
+        stays - but without this periodic re-read a DB that wasn't up at
+        startup would freeze the flag False (filtering permanently off)
+        until pod restart, and dashboard channel changes would never apply.
+        """
+        current_time = time.time()
+        if current_time - self._last_yt_enabled_check < YT_ENABLED_REFRESH_INTERVAL:
+            return
+
+        self._last_yt_enabled_check = current_time
+        enabled = self.check_youtube_access.is_enabled
+        if enabled != self._yt_enabled:
+            logger.info("🔄 YouTube filtering flag changed: %s -> %s", self._yt_enabled, enabled)
+            self._yt_enabled = enabled
+
     def _get_device_id_from_flow(self, flow) -> str:
         """Get device ID from VPN client IP address.
 
@@ -312,10 +578,10 @@ class ProxyHandler:
             client_ip = flow.client_conn.peername[0] if flow.client_conn.peername else None
             if client_ip:
                 device_id = VPN_IP_TO_DEVICE_ID.get(client_ip, DEFAULT_DEVICE_ID)
-                logging.debug(f"Client IP {client_ip} -> Device ID {device_id}")
+                logger.debug("Client IP %s -> Device ID %s", client_ip, device_id)
                 return device_id
         except Exception as e:
-            logging.error(f"Error getting device ID from flow: {e}")
+            logger.error("Error getting device ID from flow: %s", e)
         return DEFAULT_DEVICE_ID
 
     def _check_device_location(self, device_id: str = None) -> None:
@@ -350,9 +616,9 @@ class ProxyHandler:
                 if not has_fresh:
                     age = self.location_repository.get_location_data_age_seconds()
                     if age is not None:
-                        logging.warning(f"🚫 LOCATION DATA STALE for device {device_id}: Last update was {age}s ago (max: {MAX_LOCATION_AGE_SECONDS}s)")
+                        logger.warning("🚫 LOCATION DATA STALE for device %s: Last update was %ss ago (max: %ss)", device_id, age, MAX_LOCATION_AGE_SECONDS)
                     else:
-                        logging.warning(f"🚫 NO LOCATION DATA for device {device_id}")
+                        logger.warning("🚫 NO LOCATION DATA for device %s", device_id)
                     self._location_data_missing[device_id] = True
                 else:
                     self._location_data_missing[device_id] = False
@@ -365,18 +631,30 @@ class ProxyHandler:
             coordinates = self.location_repository.get_device_location(device_id=device_id)
 
             if coordinates:
-                logging.info(f"📍 Checking MDM location for device {device_id}: lat={coordinates.latitude}, lng={coordinates.longitude}")
+                logger.info("📍 Checking MDM location for device %s: lat=%s, lng=%s", device_id, coordinates.latitude, coordinates.longitude)
                 # Verify location against blocked zones
                 location_decision = self.verify_location.execute(coordinates)
-                logging.info(f"📍 Location check result: blocked={self.verify_location.is_blocked}")
+                logger.info("📍 Location check result: blocked=%s", self.verify_location.is_blocked)
             else:
-                logging.warning(f"⚠️ No location available for device {device_id} - location check skipped")
+                logger.warning("⚠️ No location available for device %s - location check skipped", device_id)
         except Exception as e:
-            logging.error(f"❌ Error checking device location: {e}")
+            logger.error("❌ Error checking device location: %s", e)
+
+    def _serve_location_script(self, flow):
+        """Serve the location overlay script with browser-cache headers."""
+        cache_headers = {
+            "Content-Type": "application/javascript",
+            "Cache-Control": "public, max-age=3600",
+            "ETag": _LOCATION_OVERLAY_JS_ETAG,
+        }
+        if flow.request.headers.get("If-None-Match") == _LOCATION_OVERLAY_JS_ETAG:
+            flow.response = http.Response.make(304, b"", cache_headers)
+            return
+        flow.response = http.Response.make(200, _LOCATION_OVERLAY_JS_BYTES, cache_headers)
 
     def _handle_location_tracking(self, flow):
         """Handle location tracking endpoint."""
-        logging.info(f"📍 Received location tracking request from {flow.request.host}")
+        logger.info("📍 Received location tracking request from %s", flow.request.host)
         try:
             data = json.loads(flow.request.content)
 
@@ -387,7 +665,7 @@ class ProxyHandler:
             url = data.get('url', 'unknown')
 
             # Log the received location prominently
-            logging.info(f"📍📍📍 LOCATION RECEIVED: lat={latitude}, lng={longitude}, accuracy={accuracy}m, url={url}")
+            logger.info("📍📍📍 LOCATION RECEIVED: lat=%s, lng=%s, accuracy=%sm, url=%s", latitude, longitude, accuracy, url)
 
             coordinates = GPSCoordinates(
                 latitude=latitude,
@@ -410,7 +688,7 @@ class ProxyHandler:
             location_decision = self.verify_location.execute(coordinates)
 
             # Log the decision
-            logging.info(f"📍 Location check result: allowed={location_decision.allowed}, message={location_decision.message}")
+            logger.info("📍 Location check result: allowed=%s, message=%s", location_decision.allowed, location_decision.message)
 
             # Build response
             response_data = {
@@ -421,7 +699,7 @@ class ProxyHandler:
             # If blocked, include block page
             if not location_decision.allowed:
                 blocked_zone_name = self.verify_location.blocked_zone_name or "a blocked location"
-                logging.warning(f"📍🚫 USER AT BLOCKED LOCATION: {blocked_zone_name}")
+                logger.warning("📍🚫 USER AT BLOCKED LOCATION: %s", blocked_zone_name)
                 response_data["block_page"] = self.block_page_renderer.render_location_block_page(
                     blocked_zone_name
                 )
@@ -432,7 +710,7 @@ class ProxyHandler:
                 {"Content-Type": "application/json"}
             )
         except Exception as e:
-            logging.error(f"❌ Error processing location: {e}")
+            logger.error("❌ Error processing location: %s", e)
             flow.response = http.Response.make(
                 400,
                 b'{"status": "error"}',
@@ -458,7 +736,7 @@ class ProxyHandler:
                 return
 
             # Check if YouTube filtering is enabled
-            if not self.check_youtube_access.is_enabled:
+            if not self._yt_enabled:
                 flow.response = http.Response.make(
                     200,
                     json.dumps({"blocked": False, "reason": "filtering disabled"}).encode('utf-8'),
@@ -471,7 +749,7 @@ class ProxyHandler:
             decision = self.check_youtube_access.execute(fake_url)
 
             blocked = not decision.allowed
-            logging.info(f"📺 YouTube video check: {video_id} -> {'BLOCKED' if blocked else 'ALLOWED'}")
+            logger.info("📺 YouTube video check: %s -> %s", video_id, 'BLOCKED' if blocked else 'ALLOWED')
 
             # Update approved video tracking
             if decision.allowed and "whitelisted" in decision.message:
@@ -490,7 +768,7 @@ class ProxyHandler:
             )
 
         except Exception as e:
-            logging.error(f"❌ Error checking YouTube video: {e}")
+            logger.error("❌ Error checking YouTube video: %s", e)
             flow.response = http.Response.make(
                 200,
                 json.dumps({"blocked": False, "error": str(e)}).encode('utf-8'),
@@ -513,12 +791,12 @@ class ProxyHandler:
 
         # Extract hostname and base domain (handles IP addresses and SNI)
         full_hostname, base_domain = self._extract_base_domain(flow)
-        logging.info(f"🔒 Blocked location check: host={full_host}, hostname={full_hostname}, base={base_domain}")
+        logger.info("🔒 Blocked location check: host=%s, hostname=%s, base=%s", full_host, full_hostname, base_domain)
 
         # 1. Always allow essential Apple hosts (for device functionality)
         essential_hosts = ["apple.com", "icloud.com", "icloud-content.com", "mzstatic.com"]
         if any(essential in base_domain for essential in essential_hosts):
-            logging.info(f"✅ ALLOWING {full_hostname} at {blocked_zone_name} (essential host)")
+            logger.info("✅ ALLOWING %s at %s (essential host)", full_hostname, blocked_zone_name)
             return
 
         # 2. Check per-location whitelist
@@ -526,28 +804,52 @@ class ProxyHandler:
             whitelisted_domains = self.location_repository.get_location_whitelist(blocked_zone_id)
             for domain in whitelisted_domains:
                 if domain in full_hostname or domain in base_domain:
-                    logging.info(f"✅ ALLOWING {full_hostname} at {blocked_zone_name} (per-location whitelist: {domain})")
+                    logger.info("✅ ALLOWING %s at %s (per-location whitelist: %s)", full_hostname, blocked_zone_name, domain)
                     return
 
         # 3. Block everything else
-        logging.warning(f"🚫 BLOCKED at {blocked_zone_name}: {full_hostname} (base: {base_domain})")
+        logger.warning("🚫 BLOCKED at %s: %s (base: %s)", blocked_zone_name, full_hostname, base_domain)
         self._send_location_block_response(flow)
 
     def _send_location_block_response(self, flow):
         """Send location-based block response."""
         blocked_zone_name = self.verify_location.blocked_zone_name or "a blocked location"
-        logging.warning(f"🚫 BLOCKED - At {blocked_zone_name}. Browsing not allowed.")
+        logger.warning("🚫 BLOCKED - At %s. Browsing not allowed.", blocked_zone_name)
 
-        block_page = self.block_page_renderer.render_location_block_page(blocked_zone_name)
         flow.response = http.Response.make(
             403,
-            block_page.encode('utf-8'),
+            self._location_block_bytes(blocked_zone_name),
             {"Content-Type": "text/html; charset=utf-8"}
         )
 
+    def _render_domain_block_bytes(self, base_domain: str) -> bytes:
+        """Render and encode the static domain block page (LRU-cached).
+
+        Only the static page is cached: the location tracking script depends
+        on live blocked-zone state, so it is spliced per request in
+        _domain_block_response_bytes. Caching the injected page would freeze
+        the zones-configured decision at first render.
+        """
+        return self.block_page_renderer.render_domain_block_page(
+            base_domain).encode('utf-8')
+
+    def _domain_block_response_bytes(self, base_domain: str) -> bytes:
+        """Cached static block page plus the per-request location script."""
+        body = self._domain_block_bytes(base_domain)
+        # Inject location tracking script so we can detect if at blocked location
+        script = self._get_location_tracking_script()
+        if script:
+            body = self._splice_script_into_bytes(body, script.encode('utf-8'))
+        return body
+
+    def _render_location_block_bytes(self, blocked_zone_name: str) -> bytes:
+        """Render and encode the location block page (LRU-cached)."""
+        return self.block_page_renderer.render_location_block_page(
+            blocked_zone_name).encode('utf-8')
+
     def _send_no_location_block_response(self, flow):
         """Send block response when no location data is available from any device."""
-        logging.warning(f"🚫 BLOCKED - No location data from any device. All traffic blocked.")
+        logger.warning("🚫 BLOCKED - No location data from any device. All traffic blocked.")
 
         block_page = self.block_page_renderer.render_no_location_block_page()
         flow.response = http.Response.make(
@@ -614,12 +916,12 @@ class ProxyHandler:
             return html
 
         # Inject before </body> or </html> or at end
-        if "</body>" in html:
-            return html.replace("</body>", script + "</body>")
-        elif "</html>" in html:
-            return html.replace("</html>", script + "</html>")
-        else:
-            return html + script
+        index = html.rfind("</body>")
+        if index < 0:
+            index = html.rfind("</html>")
+        if index >= 0:
+            return html[:index] + script + html[index:]
+        return html + script
 
     def _extract_base_domain(self, flow) -> tuple[str, str]:
         """
@@ -638,17 +940,17 @@ class ProxyHandler:
             if sni_host:
                 extracted = tldextract.extract(sni_host)
                 base_domain = f"{extracted.domain}.{extracted.suffix}"
-                logging.info(f"Direct IP connection (SNI: {sni_host}, base: {base_domain})")
+                logger.info("Direct IP connection (SNI: %s, base: %s)", sni_host, base_domain)
                 return (sni_host, base_domain)
             else:
                 base_domain = full_host.split(':')[0]
-                logging.info(f"Direct IP connection: {base_domain} (no SNI)")
+                logger.info("Direct IP connection: %s (no SNI)", base_domain)
                 return (base_domain, base_domain)
         except ValueError:
             # Not an IP, extract base domain normally
             extracted = tldextract.extract(full_host)
             base_domain = f"{extracted.domain}.{extracted.suffix}"
-            logging.info(f"base domain {base_domain}")
+            logger.info("base domain %s", base_domain)
             return (full_host, base_domain)
 
     def _build_full_url(self, flow) -> str:
@@ -695,18 +997,70 @@ class ProxyHandler:
             # Check first 20 chars after the /
             sample = path[1:21] if len(path) > 21 else path[1:]
             if all(c in base64_chars for c in sample):
-                logging.info(f"🔐 Detected OCSP request: {flow.request.host}:{flow.request.port}{path[:50]}...")
+                logger.info("🔐 Detected OCSP request: %s:%s%s...", flow.request.host, flow.request.port, path[:50])
                 return True
 
         return False
 
+    @staticmethod
+    def _splice_script_into_bytes(body: bytes, script_bytes: bytes) -> bytes:
+        """Splice a script block into HTML bytes before the last </body>/</html>."""
+        match = None
+        for match in _CLOSE_TAG_RE.finditer(body):
+            pass
+        if match:
+            index = match.start()
+            return body[:index] + script_bytes + body[index:]
+        return body + script_bytes
+
+    def _splice_script_into_response(self, flow, script: str) -> None:
+        """Splice a script block into an HTML response before </body>/</html>.
+
+        For uncompressed responses this works directly on the body bytes,
+        skipping the full charset decode/encode round-trip that the .text
+        property performs. Compressed bodies fall back to .text so
+        mitmproxy handles decompression and re-encoding.
+        """
+        content_encoding = flow.response.headers.get("content-encoding", "")
+        if content_encoding in ("", "identity"):
+            body = flow.response.content
+            script_bytes = script.encode('utf-8')
+            # One linear regex pass finds the last closing tag; the slice
+            # concatenation then allocates once
+            match = None
+            for match in _CLOSE_TAG_RE.finditer(body):
+                pass
+            if match:
+                index = match.start()
+                flow.response.content = body[:index] + script_bytes + body[index:]
+            else:
+                flow.response.content = body + script_bytes
+            return
+
+        html = flow.response.text
+        index = html.rfind("</body>")
+        if index < 0:
+            index = html.rfind("</html>")
+        if index >= 0:
+            flow.response.text = html[:index] + script + html[index:]
+        else:
+            flow.response.text = html + script
+
     def _inject_location_tracking_script(self, flow):
         """Inject location tracking JavaScript into HTML responses."""
         full_host = flow.request.host
 
+        # Skip HTML fragments fetched via XHR/fetch - injecting a fullscreen
+        # permission overlay into partial responses is wrong and wasteful.
+        # Sec-Fetch-Dest is "document" for top-level navigations; treat a
+        # missing header (older browsers) as a document.
+        if flow.request.headers.get("Sec-Fetch-Dest", "document") != "document":
+            logger.debug("📍 Skipping location injection for %s: not a document fetch", full_host)
+            return
+
         # Skip injection entirely if no blocked zones are configured
         if not self.verify_location.has_blocked_zones:
-            logging.debug(f"📍 Skipping location injection for {full_host}: no blocked zones configured")
+            logger.debug("📍 Skipping location injection for %s: no blocked zones configured", full_host)
             return
 
         # Skip injection if user is already at a blocked location
@@ -714,7 +1068,7 @@ class ProxyHandler:
         # This prevents the tracking script from showing a block page
         # on domains that were allowed via the per-location whitelist
         if self.verify_location.is_blocked:
-            logging.debug(f"📍 Skipping location injection for {full_host}: already at blocked location")
+            logger.debug("📍 Skipping location injection for %s: already at blocked location", full_host)
             return
 
         # Skip injection for essential/auth domains (to avoid breaking login flows)
@@ -732,231 +1086,32 @@ class ProxyHandler:
         ]
 
         if any(domain in full_host for domain in essential_domains):
-            logging.debug(f"📍 Skipping location injection for {full_host}: essential domain")
+            logger.debug("📍 Skipping location injection for %s: essential domain", full_host)
             return
 
         # For debugging/test visibility, log every successful injection opportunity
-        logging.info(f"📍 Injecting location overlay into {full_host}")
+        logger.info("📍 Injecting location overlay into %s", full_host)
 
         content_type = flow.response.headers.get("content-type", "")
         if "text/html" not in content_type:
-            logging.debug(f"📍 Skipping location injection for {full_host}: content-type is {content_type}")
+            logger.debug("📍 Skipping location injection for %s: content-type is %s", full_host, content_type)
             return
         if flow.response.status_code != 200:
-            logging.debug(f"📍 Skipping location injection for {full_host}: status code is {flow.response.status_code}")
+            logger.debug("📍 Skipping location injection for %s: status code is %s", full_host, flow.response.status_code)
             return
 
         # At this point we have an HTML response that needs location tracking
         try:
-            location_script = """
-<style>
-#location-permission-overlay {
-    position: fixed;
-    top: 0;
-    left: 0;
-    width: 100%;
-    height: 100%;
-    background: rgba(0, 0, 0, 0.95);
-    z-index: 999999;
-    display: flex;
-    align-items: center;
-    justify-content: center;
-    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-}
-#location-permission-content {
-    background: white;
-    border-radius: 20px;
-    padding: 40px;
-    max-width: 500px;
-    text-align: center;
-    box-shadow: 0 20px 60px rgba(0,0,0,0.5);
-}
-#location-permission-content .icon {
-    font-size: 60px;
-    margin-bottom: 20px;
-}
-#location-permission-content h2 {
-    color: #333;
-    margin: 0 0 15px 0;
-}
-#location-permission-content p {
-    color: #666;
-    line-height: 1.6;
-    margin: 15px 0;
-}
-#location-permission-content .spinner {
-    border: 4px solid #f3f3f3;
-    border-top: 4px solid #667eea;
-    border-radius: 50%;
-    width: 40px;
-    height: 40px;
-    animation: spin 1s linear infinite;
-    margin: 20px auto;
-}
-@keyframes spin {
-    0% { transform: rotate(0deg); }
-    100% { transform: rotate(360deg); }
-}
-#location-permission-content .error {
-    color: #d93025;
-    font-weight: 600;
-}
-#location-permission-content .btn {
-    background: #667eea;
-    color: white;
-    border: none;
-    padding: 12px 24px;
-    border-radius: 8px;
-    font-size: 16px;
-    cursor: pointer;
-    margin-top: 20px;
-    font-family: inherit;
-}
-#location-permission-content .btn:hover {
-    background: #5568d3;
-}
-</style>
-<div id="location-permission-overlay">
-    <div id="location-permission-content">
-        <div class="icon">📍</div>
-        <h2>Location Required</h2>
-        <p>This site requires location permission to verify access.</p>
-        <div class="spinner"></div>
-        <p id="location-status">Waiting for permission...</p>
-    </div>
-</div>
-<script>
-(function() {
-    // Check if location was already tracked this session
-    var locationTracked = sessionStorage.getItem('locationTracked');
-    var overlay = document.getElementById('location-permission-overlay');
-
-    if (locationTracked === 'true') {
-        // Already tracked - hide overlay immediately
-        if (overlay) {
-            overlay.style.display = 'none';
-        }
-        return;
-    }
-
-    var status = document.getElementById('location-status');
-    var promptTimeout = null;
-    var permissionRequested = false;
-
-    function hideOverlay() {
-        if (overlay) {
-            overlay.style.display = 'none';
-        }
-        if (promptTimeout) {
-            clearTimeout(promptTimeout);
-        }
-    }
-
-    function markLocationTracked() {
-        try {
-            sessionStorage.setItem('locationTracked', 'true');
-        } catch(e) {}
-    }
-
-    function showError(message) {
-        status.innerHTML = '<span class="error">' + message + '</span>';
-        var spinner = document.querySelector('.spinner');
-        if (spinner) {
-            spinner.style.display = 'none';
-        }
-        if (promptTimeout) {
-            clearTimeout(promptTimeout);
-        }
-    }
-
-    // Set timeout to detect if permission prompt never appears
-    promptTimeout = setTimeout(function() {
-        if (!permissionRequested) {
-            showError('⚠️ Location permission prompt not shown.<br><br>Location services may be disabled in Safari settings or system preferences.<br><br>To enable: Settings > Safari > Location Services > Allow');
-        }
-    }, 2000);
-
-    if (navigator.geolocation) {
-        navigator.geolocation.getCurrentPosition(function(position) {
-            permissionRequested = true;
-            if (promptTimeout) {
-                clearTimeout(promptTimeout);
-            }
-            status.textContent = 'Verifying location...';
-            var data = {
-                latitude: position.coords.latitude,
-                longitude: position.coords.longitude,
-                accuracy: position.coords.accuracy,
-                altitude: position.coords.altitude,
-                url: window.location.href,
-                timestamp: new Date().toISOString(),
-                device_id: 'iPhone'
-            };
-            fetch('/__track_location__', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify(data)
-            }).then(function(response) {
-                return response.json();
-            }).then(function(json) {
-                if (json.blocked) {
-                    document.body.innerHTML = json.block_page;
-                } else {
-                    markLocationTracked();
-                    hideOverlay();
-                }
-            }).catch(function(err) {
-                markLocationTracked();
-                hideOverlay();
-            });
-        }, function(error) {
-            permissionRequested = true;
-            if (promptTimeout) {
-                clearTimeout(promptTimeout);
-            }
-            if (error.code === 1) {
-                showError('⚠️ Location permission denied.<br><br>Please enable location access in Safari settings to browse.<br><br>Settings > Safari > Location Services > Allow', true);
-            } else if (error.code === 2) {
-                showError('⚠️ Location unavailable.<br><br>Unable to determine your location. Please check your device settings.', true);
-            } else {
-                showError('⚠️ Location request timed out.<br><br>Please check your connection and try again.', true);
-            }
-        }, {
-            enableHighAccuracy: true,
-            timeout: 10000,
-            maximumAge: 0
-        });
-    } else {
-        if (promptTimeout) {
-            clearTimeout(promptTimeout);
-        }
-        showError('⚠️ Geolocation not supported.<br><br>Your browser does not support location services.', true);
-    }
-})();
-</script>
-"""
-            html = flow.response.text
-
-            # Inject before </body> or </html> tag
-            if "</body>" in html:
-                html = html.replace("</body>", location_script + "</body>")
-                logging.info(f"📍 INJECTED location tracking script into {full_host} (before </body>)")
-            elif "</html>" in html:
-                html = html.replace("</html>", location_script + "</html>")
-                logging.info(f"📍 INJECTED location tracking script into {full_host} (before </html>)")
-            else:
-                html += location_script
-                logging.info(f"📍 INJECTED location tracking script into {full_host} (appended)")
-
-            flow.response.text = html
+            self._splice_script_into_response(flow, _LOCATION_SCRIPT_TAG)
+            logger.info("📍 INJECTED location script tag into %s", full_host)
 
         except Exception as e:
-            logging.error(f"❌ Error injecting location script: {e}")
+            logger.error("❌ Error injecting location script: %s", e)
 
     def _inject_youtube_blocking_script(self, flow):
         """Inject JavaScript into YouTube pages to show block overlay for SPA navigation."""
         # Only inject if YouTube filtering is enabled
-        if not self.check_youtube_access.is_enabled:
+        if not self._yt_enabled:
             return
 
         # Only inject into YouTube HTML responses
@@ -964,7 +1119,8 @@ class ProxyHandler:
         full_host = flow.request.host
         sni_host = flow.client_conn.sni if hasattr(flow.client_conn, 'sni') and flow.client_conn.sni else None
 
-        is_youtube = 'youtube.com' in full_host or (sni_host and 'youtube.com' in sni_host)
+        is_youtube = _is_host_or_subdomain(full_host, 'youtube.com') or (
+            sni_host and _is_host_or_subdomain(sni_host, 'youtube.com'))
         if not is_youtube:
             return
 
@@ -1099,21 +1255,11 @@ class ProxyHandler:
 })();
 </script>
 """
-            html = flow.response.text
-
-            # Inject before </body> or </html> tag
-            if "</body>" in html:
-                html = html.replace("</body>", youtube_block_script + "</body>")
-            elif "</html>" in html:
-                html = html.replace("</html>", youtube_block_script + "</html>")
-            else:
-                html += youtube_block_script
-
-            flow.response.text = html
-            logging.info("📺 Injected YouTube blocking script")
+            self._splice_script_into_response(flow, youtube_block_script)
+            logger.info("📺 Injected YouTube blocking script")
 
         except Exception as e:
-            logging.error(f"❌ Error injecting YouTube blocking script: {e}")
+            logger.error("❌ Error injecting YouTube blocking script: %s", e)
 
     def _detect_captive_portal(self, flow):
         """Detect and auto-whitelist captive portals."""
@@ -1137,9 +1283,8 @@ class ProxyHandler:
                     orig_base_domain = f"{orig_extracted.domain}.{orig_extracted.suffix}"
 
                     if redirect_base_domain != orig_base_domain:
-                        captive_portal_hosts = self.check_domain_access.CAPTIVE_PORTAL_HOSTS
-                        if any(host in flow.request.host for host in captive_portal_hosts):
-                            logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {redirect_base_domain}")
+                        if flow.request.host.endswith(self._captive_portal_suffixes):
+                            logger.info("🌐 CAPTIVE PORTAL DETECTED: %s", redirect_base_domain)
                             self.check_domain_access.add_auto_whitelisted_host(redirect_base_domain)
                         else:
                             # Track redirects
@@ -1148,17 +1293,17 @@ class ProxyHandler:
                             self.redirect_tracker[redirect_base_domain].add(orig_base_domain)
 
                             if len(self.redirect_tracker[redirect_base_domain]) >= 2:
-                                logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {redirect_base_domain}")
+                                logger.info("🌐 CAPTIVE PORTAL DETECTED: %s", redirect_base_domain)
                                 self.check_domain_access.add_auto_whitelisted_host(redirect_base_domain)
 
                 except Exception as e:
-                    logging.error(f"Error parsing redirect: {e}")
+                    logger.error("Error parsing redirect: %s", e)
 
         # Check for 511 status code
         if flow.response.status_code == 511:
             extracted = tldextract.extract(flow.request.host)
             base_domain = f"{extracted.domain}.{extracted.suffix}"
-            logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {base_domain} (511 status)")
+            logger.info("🌐 CAPTIVE PORTAL DETECTED: %s (511 status)", base_domain)
             self.check_domain_access.add_auto_whitelisted_host(base_domain)
 
 
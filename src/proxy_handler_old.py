@@ -10,22 +10,318 @@ Handles:
 Run as follows: mitmproxy -s proxy_handler.py
 """
 import re
+import functools
+import ipaddress
 import logging
 import os
 from mitmproxy import ctx, http
 import tldextract
 import psycopg
 from psycopg.rows import dict_row
-from urllib.parse import urlparse, parse_qs
+from psycopg_pool import ConnectionPool
+from urllib.parse import urlparse
 import requests
 import json
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from math import radians, cos, sqrt
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_METERS = 6371000
+
+# Injection guards: skip bodies that are huge or clearly not full documents,
+# and only look for the closing tag in the final few KB
+MAX_INJECTION_BODY_BYTES = 2 * 1024 * 1024
+INJECTION_TAIL_SEARCH_BYTES = 4096
+
+# Status codes that directly signal a captive portal; a frozenset so the
+# check stays O(1) as codes get added (e.g. 200 with a Captive-Portal header)
+CAPTIVE_STATUSES = frozenset({511})
+
+# Negative-cache sentinel for video -> channel lookups that failed, so the
+# proxy does not re-hit the YouTube API for a video it already could not
+# resolve
+_CHANNEL_LOOKUP_FAILED = object()
+
+# Matches the three YouTube URL shapes we see: watch?v=, api calls with
+# docid=, and youtu.be short links; video IDs are always 11 URL-safe chars
+_YT_VIDEO_ID_RE = re.compile(r'[?&](?:v|docid)=([A-Za-z0-9_-]{11})|youtu\.be/([A-Za-z0-9_-]{11})')
+
+# One extractor instance, pinned to the bundled suffix list (no network or
+# disk cache refresh), with memoized lookups: tldextract walks the public
+# suffix trie on every call, which is wasteful for the handful of hosts that
+# dominate real traffic
+_tld_extractor = tldextract.TLDExtract(suffix_list_urls=(), fallback_to_snapshot=True, cache_dir=None)
+
+# TLDs where the registrable domain is always the last two labels; hosts
+# ending in one of these skip the public-suffix trie walk entirely
+_COMMON_TLDS = frozenset({"com", "net", "org", "io", "dev", "co", "app", "ai", "gov", "edu"})
+
+# Second-to-last labels that can themselves start a multi-part suffix
+# (co.com-style resellers, gov/ac registries); send those to the extractor
+_AMBIGUOUS_SECOND_LABELS = frozenset({"co", "com", "net", "org", "gov", "ac", "edu"})
+
+@functools.lru_cache(maxsize=65536)
+def _base_domain(host):
+    # Fast path: the common single-label TLDs cover the bulk of traffic
+    parts = host.rsplit('.', 2)
+    if len(parts) >= 2 and parts[-1] in _COMMON_TLDS and parts[-2] not in _AMBIGUOUS_SECOND_LABELS:
+        return parts[-2] + '.' + parts[-1]
+    extracted = _tld_extractor(host)
+    return f"{extracted.domain}.{extracted.suffix}"
+
+@functools.lru_cache(maxsize=4096)
+def _is_ip_host(host):
+    """Cheap IP-literal test for the common hostname case.
+
+    Raising ValueError out of ipaddress.ip_address for every hostname is
+    expensive in CPython; almost all hosts start with a letter and can be
+    rejected without touching ipaddress. Only ambiguous strings (IPv6
+    colons) fall back to the real parser.
+    """
+    first = host.split(':', 1)[0]  # Strip port if present
+    if ':' in host:
+        # Could be an IPv6 literal or host:port - let ipaddress decide
+        try:
+            ipaddress.ip_address(first)
+            return True
+        except ValueError:
+            return False
+    if not first[:1].isdigit():
+        return False
+    parts = first.split('.')
+    return len(parts) == 4 and all(p.isdigit() and int(p) < 256 for p in parts)
+
+
+# Location block page, split around the only dynamic field (the location
+# name) so serving a blocked request is two string concatenations instead of
+# re-interpolating a ~2KB brace-escaped f-string template per request
+_BLOCK_PAGE_PREFIX = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Browsing Blocked</title>
+    <style>
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            margin: 0;
+            padding: 20px;
+            display: flex;
+            align-items: center;
+            justify-content: center;
+            min-height: 100vh;
+        }
+        .container {
+            background: white;
+            border-radius: 20px;
+            padding: 40px;
+            max-width: 500px;
+            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+            text-align: center;
+        }
+        .emoji {
+            font-size: 80px;
+            margin-bottom: 20px;
+        }
+        h1 {
+            color: #333;
+            margin: 0 0 10px 0;
+            font-size: 28px;
+        }
+        .location {
+            color: #666;
+            font-size: 16px;
+            margin: 10px 0 20px 0;
+        }
+        p {
+            color: #666;
+            line-height: 1.6;
+            margin: 20px 0;
+        }
+        .note {
+            background: #f0f0f0;
+            padding: 15px;
+            border-radius: 10px;
+            font-size: 14px;
+            margin-top: 20px;
+        }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="emoji">🚫</div>
+        <h1>Browsing Blocked</h1>
+        <div class="location">📍 """
+_BLOCK_PAGE_SUFFIX = """</div>
+        <p>You are currently at a blocked location. Internet browsing is not allowed at this location.</p>
+        <p>To browse websites, please move to a different location.</p>
+        <div class="note">
+            <strong>Note:</strong> Essential services (Apple, iCloud) remain accessible.
+        </div>
+    </div>
+</body>
+</html>"""
+
+def _location_block_page_html(location_name):
+    return _BLOCK_PAGE_PREFIX + location_name + _BLOCK_PAGE_SUFFIX
+
+
+# Path the injected overlay loads the tracking logic from; serving it as an
+# external script lets the browser cache it across pages instead of paying
+# for ~3KB of inline JS in every HTML response
+TRACKER_SCRIPT_PATH = "/__tracker.js"
+
+# Location-tracking overlay injected into HTML responses; the logic itself
+# lives in TRACKER_SCRIPT_PATH so only the overlay markup travels inline
+_LOCATION_OVERLAY_HTML = """
+<style>
+#location-permission-overlay {
+    position: fixed;
+    top: 0;
+    left: 0;
+    width: 100%;
+    height: 100%;
+    background: rgba(0, 0, 0, 0.95);
+    z-index: 999999;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
+}
+#location-permission-content {
+    background: white;
+    border-radius: 20px;
+    padding: 40px;
+    max-width: 500px;
+    text-align: center;
+    box-shadow: 0 20px 60px rgba(0,0,0,0.5);
+}
+#location-permission-content .icon {
+    font-size: 60px;
+    margin-bottom: 20px;
+}
+#location-permission-content h2 {
+    color: #333;
+    margin: 0 0 15px 0;
+}
+#location-permission-content p {
+    color: #666;
+    line-height: 1.6;
+    margin: 15px 0;
+}
+#location-permission-content .spinner {
+    border: 4px solid #f3f3f3;
+    border-top: 4px solid #667eea;
+    border-radius: 50%;
+    width: 40px;
+    height: 40px;
+    animation: spin 1s linear infinite;
+    margin: 20px auto;
+}
+@keyframes spin {
+    0% { transform: rotate(0deg); }
+    100% { transform: rotate(360deg); }
+}
+#location-permission-content .error {
+    color: #d93025;
+    font-weight: 600;
+}
+</style>
+<div id="location-permission-overlay">
+    <div id="location-permission-content">
+        <div class="icon">📍</div>
+        <h2>Location Required</h2>
+        <p>This site requires location permission to verify access.</p>
+        <div class="spinner"></div>
+        <p id="location-status">Waiting for permission...</p>
+    </div>
+</div>
+""" + f'<script src="{TRACKER_SCRIPT_PATH}" defer></script>\n'
+_LOCATION_OVERLAY_HTML_BYTES = _LOCATION_OVERLAY_HTML.encode('utf-8')
+
+# The tracking logic served from TRACKER_SCRIPT_PATH, encoded once
+_TRACKER_JS = """
+(function() {
+    var overlay = document.getElementById('location-permission-overlay');
+    var status = document.getElementById('location-status');
+
+    function hideOverlay() {
+        if (overlay) {
+            overlay.style.display = 'none';
+        }
+    }
+
+    function showError(message) {
+        status.innerHTML = '<span class="error">' + message + '</span>';
+        document.querySelector('.spinner').style.display = 'none';
+    }
+
+    if (navigator.geolocation) {
+        navigator.geolocation.getCurrentPosition(function(position) {
+            status.textContent = 'Verifying location...';
+            var data = {
+                latitude: position.coords.latitude,
+                longitude: position.coords.longitude,
+                accuracy: position.coords.accuracy,
+                altitude: position.coords.altitude,
+                url: window.location.href,
+                timestamp: new Date().toISOString(),
+                device_id: 'iPhone'
+            };
+            fetch('/__track_location__', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(data)
+            }).then(function(response) {
+                return response.json();
+            }).then(function(json) {
+                if (json.blocked) {
+                    // At blocked location - replace page with block message
+                    document.body.innerHTML = json.block_page;
+                } else {
+                    // Not at blocked location - hide overlay and show page
+                    hideOverlay();
+                }
+            }).catch(function(err) {
+                // Network error - allow page to show (fail open)
+                hideOverlay();
+            });
+        }, function(error) {
+            if (error.code === 1) {
+                showError('⚠️ Location permission denied.<br><br>You must grant location permission to browse websites.<br><br>Please refresh and allow location access.');
+            } else if (error.code === 2) {
+                showError('⚠️ Location unavailable.<br><br>Unable to determine your location. Please check your device settings.');
+            } else {
+                showError('⚠️ Location request timed out.<br><br>Please refresh the page to try again.');
+            }
+        }, {
+            enableHighAccuracy: true,
+            timeout: 10000,
+            maximumAge: 0
+        });
+    } else {
+        showError('⚠️ Geolocation not supported.<br><br>Your browser does not support location services.');
+    }
+})();
+"""
+_TRACKER_JS_BYTES = _TRACKER_JS.encode('utf-8')
 
 class Counter:
     def __init__(self):
         self.num = 0
         # Dynamic list for auto-detected captive portals
-        self.auto_whitelisted_hosts = set()
-        self.redirect_tracker = {}  # Track redirects to detect captive portals
+        # Maps domain -> monotonic expiry time; captive portal sessions are
+        # temporary, so auto-whitelistings lapse instead of living forever
+        self.auto_whitelisted_hosts: dict[str, float] = {}
+        # Track redirects to detect captive portals; bounded FIFO with
+        # per-entry expiry so a long-running proxy cannot leak memory and
+        # stale redirect evidence ages out
+        self.redirect_tracker: collections.OrderedDict[str, tuple[float, set[str]]] = collections.OrderedDict()
 
         # Database connection details (from environment variables)
         self.db_host = os.getenv('POSTGRES_HOST', 'localhost')
@@ -34,12 +330,52 @@ class Counter:
         self.db_user = os.getenv('POSTGRES_USER', 'mitmproxy')
         self.db_password = os.getenv('POSTGRES_PASSWORD', 'mitmproxy')
 
+        # Pooled connections: a fresh psycopg.connect() per query pays a full
+        # TCP + auth handshake, which dominates latency on the hot
+        # /__track_location__ path
+        conn_string = f"host={self.db_host} port={self.db_port} dbname={self.db_name} user={self.db_user} password={self.db_password}"
+        self.conn_string = conn_string
+        self.pool = ConnectionPool(
+            conn_string,
+            min_size=2,
+            max_size=10,
+            kwargs={"row_factory": dict_row},
+            configure=self._configure_pooled_connection,
+        )
+
         # YouTube filtering
         self.youtube_api_key = os.getenv('YOUTUBE_API_KEY', '')
-        self.video_to_channel_cache = {}  # Cache video_id -> channel_id mapping
-        self.allowed_youtube_channels = []  # Loaded from database
+        # Maps video_id -> channel_id, _CHANNEL_LOOKUP_FAILED, or an
+        # in-flight Future from the lookup executor
+        self.video_to_channel_cache = {}
+        # API lookups run here so a slow YouTube API call cannot stall
+        # mitmproxy's single-threaded event loop; the Session keeps the
+        # HTTPS connection to googleapis.com alive between lookups
+        self._yt_api_session = requests.Session()
+        self._yt_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='yt-api')
+        self.allowed_youtube_channels = frozenset()  # Loaded from database
         self.youtube_filter_enabled = False
 
+        # Pending location rows flushed in batches (see store_location)
+        self._pending_locations = collections.deque()
+        self._last_location_flush = time.monotonic()
+
+        # Precompute per-location radians / cos(lat) / squared radius as
+        # parallel tuples (structure-of-arrays) so the distance check is one
+        # tight zip loop with a couple of multiplications per location,
+        # regardless of how long BLOCKED_LOCATIONS grows
+        self._blk_lat_rad = tuple(radians(l['latitude']) for l in self.BLOCKED_LOCATIONS)
+        self._blk_lon_rad = tuple(radians(l['longitude']) for l in self.BLOCKED_LOCATIONS)
+        self._blk_cos_lat = tuple(cos(radians(l['latitude'])) for l in self.BLOCKED_LOCATIONS)
+        self._blk_radius_sq = tuple(l['radius_meters'] ** 2 for l in self.BLOCKED_LOCATIONS)
+
+        # Whitelist lookup structures derived from ALLOWED_HOSTS
+        self._rebuild_allowed_lookups()
+
+        # Per-host classification cache; cleared whenever the whitelist
+        # reloads or a captive portal is auto-whitelisted
+        self._host_decision_cache = {}
+
         # Location-based blocking
         self.currently_at_blocked_location = False
         self.current_blocked_location_name = None
@@ -61,18 +397,60 @@ class Counter:
         }
     ]
 
+    # Host classification results cached per full hostname
+    DECISION_ALLOW = 'allow'
+    DECISION_ALLOW_YOUTUBE_CHECK = 'allow_youtube_check'
+    DECISION_BLOCK = 'block'
+    HOST_DECISION_CACHE_MAX = 8192
+
+    # Caps for long-lived tracking structures; a proxy that runs for weeks
+    # must not grow without bound on one-off domains and videos
+    REDIRECT_TRACKER_MAX = 1024
+    REDIRECT_TRACKER_TTL_SECONDS = 600
+    AUTO_WHITELIST_MAX = 256
+    AUTO_WHITELIST_TTL_SECONDS = 3600
+    VIDEO_CACHE_MAX = 4096
+
+    # Postgres channels the admin backend notifies on whitelist changes
+    DB_NOTIFY_CHANNELS = ('allowed_hosts_changed', 'youtube_channels_changed')
+
+    # Batch location INSERTs: flush after this many rows or this many seconds
+    LOCATION_BATCH_SIZE = 10
+    LOCATION_FLUSH_INTERVAL_SECONDS = 5.0
+
     # Essential hosts that must always work (iOS functionality, WiFi login)
     ESSENTIAL_HOSTS = ["apple.com", "icloud.com", "icloud-content.com", "mzstatic.com"]
+    ESSENTIAL_HOSTS_SET = frozenset(ESSENTIAL_HOSTS)
 
     # Whitelist: Loaded from PostgreSQL (fallback if DB unavailable)
     ALLOWED_HOSTS = ["amazon.com"]
 
+    @staticmethod
+    def _configure_pooled_connection(conn):
+        """Applied to every connection the pool hands out.
+
+        prepare_threshold=0 makes psycopg prepare statements server-side on
+        first execution instead of after five repeats, so the recurring
+        location INSERT skips the Parse/Describe roundtrip from the start;
+        prepared statements persist across pool checkouts on the same
+        connection.
+        """
+        conn.prepare_threshold = 0
+
+    def _rebuild_allowed_lookups(self):
+        """Rebuild the set/suffix structures used for whitelist matching.
+
+        Substring scans over ALLOWED_HOSTS are O(hosts x host length) per
+        request; an exact-match frozenset plus an endswith() suffix tuple is
+        effectively constant and only matches real subdomains.
+        """
+        self._allowed_set = frozenset(self.ALLOWED_HOSTS)
+        self._allowed_suffixes = tuple('.' + host for host in self.ALLOWED_HOSTS)
+
     def load_allowed_hosts_from_db(self):
         """Load allowed hosts from PostgreSQL database"""
         try:
-            # Connect to PostgreSQL using psycopg (v3)
-            conn_string = f"host={self.db_host} port={self.db_port} dbname={self.db_name} user={self.db_user} password={self.db_password}"
-            with psycopg.connect(conn_string, row_factory=dict_row) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cursor:
                     # Query enabled allowed hosts
                     cursor.execute("SELECT domain FROM allowed_hosts WHERE enabled = true")
@@ -80,69 +458,58 @@ class Counter:
 
                     # Update ALLOWED_HOSTS list
                     self.ALLOWED_HOSTS = [row['domain'] for row in rows]
+                    self._rebuild_allowed_lookups()
+                    self._host_decision_cache.clear()
 
-                    logging.info(f"✅ Loaded {len(self.ALLOWED_HOSTS)} allowed hosts from database: {self.ALLOWED_HOSTS}")
+                    logger.info("✅ Loaded %s allowed hosts from database: %s", len(self.ALLOWED_HOSTS), self.ALLOWED_HOSTS)
 
         except Exception as e:
-            logging.error(f"❌ Failed to load allowed hosts from database: {e}")
-            logging.info(f"Using fallback allowed hosts: {self.ALLOWED_HOSTS}")
+            logger.error("❌ Failed to load allowed hosts from database: %s", e)
+            logger.info("Using fallback allowed hosts: %s", self.ALLOWED_HOSTS)
 
     def load_allowed_youtube_channels_from_db(self):
         """Load allowed YouTube channels from PostgreSQL database"""
         try:
-            conn_string = f"host={self.db_host} port={self.db_port} dbname={self.db_name} user={self.db_user} password={self.db_password}"
-            with psycopg.connect(conn_string, row_factory=dict_row) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cursor:
                     # Query enabled YouTube channels
                     cursor.execute("SELECT channel_id, channel_name FROM youtube_channels WHERE enabled = true")
                     rows = cursor.fetchall()
 
-                    # Update allowed channels list
-                    self.allowed_youtube_channels = [row['channel_id'] for row in rows]
+                    # Swap in a fresh frozenset atomically: readers on the
+                    # hot path see either the old or the new whitelist, and
+                    # the per-video membership test stays O(1)
+                    self.allowed_youtube_channels = frozenset(row['channel_id'] for row in rows)
                     self.youtube_filter_enabled = len(self.allowed_youtube_channels) > 0
 
                     if self.youtube_filter_enabled:
                         channel_names = [row['channel_name'] for row in rows]
-                        logging.info(f"✅ YouTube filtering ENABLED for {len(self.allowed_youtube_channels)} channels: {channel_names}")
+                        logger.info("✅ YouTube filtering ENABLED for %s channels: %s", len(self.allowed_youtube_channels), channel_names)
                     else:
-                        logging.info("ℹ️  YouTube filtering DISABLED (no channels configured)")
+                        logger.info("ℹ️  YouTube filtering DISABLED (no channels configured)")
 
         except Exception as e:
-            logging.error(f"❌ Failed to load YouTube channels from database: {e}")
+            logger.error("❌ Failed to load YouTube channels from database: %s", e)
             self.youtube_filter_enabled = False
 
-    def calculate_distance(self, lat1, lon1, lat2, lon2):
-        """Calculate distance between two GPS coordinates in meters using Haversine formula"""
-        from math import radians, sin, cos, sqrt, atan2
-
-        # Earth radius in meters
-        R = 6371000
-
-        # Convert to radians
-        lat1_rad = radians(lat1)
-        lat2_rad = radians(lat2)
-        delta_lat = radians(lat2 - lat1)
-        delta_lon = radians(lon2 - lon1)
-
-        # Haversine formula
-        a = sin(delta_lat / 2) ** 2 + cos(lat1_rad) * cos(lat2_rad) * sin(delta_lon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        distance = R * c
-
-        return distance
-
     def is_at_blocked_location(self, latitude, longitude):
         """Check if current location is within any blocked location radius
         Returns: (is_blocked, location_info, distance) tuple
+
+        Uses an equirectangular approximation instead of Haversine: at the
+        ~100m radii used here it is accurate to well under 0.1% and needs no
+        trig per location, and the sqrt only runs on an actual match.
         """
-        for location in self.BLOCKED_LOCATIONS:
-            distance = self.calculate_distance(
-                latitude, longitude,
-                location['latitude'],
-                location['longitude']
-            )
-            if distance <= location['radius_meters']:
-                return (True, location, distance)
+        lat_rad = radians(latitude)
+        lon_rad = radians(longitude)
+        for location, blk_lat, blk_lon, blk_cos, radius_sq in zip(
+                self.BLOCKED_LOCATIONS, self._blk_lat_rad, self._blk_lon_rad,
+                self._blk_cos_lat, self._blk_radius_sq):
+            dx = (lon_rad - blk_lon) * blk_cos * EARTH_RADIUS_METERS
+            dy = (lat_rad - blk_lat) * EARTH_RADIUS_METERS
+            dist_sq = dx * dx + dy * dy
+            if dist_sq <= radius_sq:
+                return (True, location, sqrt(dist_sq))
         return (False, None, None)
 
     def store_location(self, latitude, longitude, url, timestamp, accuracy=None, altitude=None, device_id='iPhone'):
@@ -158,73 +525,115 @@ class Counter:
 
             # Log blocking status
             if is_blocked:
-                logging.warning(f"🚫 BLOCKING ENABLED - You are at blocked location ({blocked_location['name']}) - {distance:.0f}m away")
+                logger.warning("🚫 BLOCKING ENABLED - You are at blocked location (%s) - %.0fm away", blocked_location['name'], distance)
             else:
-                logging.info(f"✅ Browsing allowed - Not at any blocked location")
+                logger.info("✅ Browsing allowed - Not at any blocked location")
 
-            # Store in database
-            conn_string = f"host={self.db_host} port={self.db_port} dbname={self.db_name} user={self.db_user} password={self.db_password}"
-            with psycopg.connect(conn_string) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(
-                        """INSERT INTO locations (device_id, latitude, longitude, accuracy, altitude, url, timestamp)
-                           VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                        (device_id, latitude, longitude, accuracy, altitude, url, timestamp)
-                    )
-                    conn.commit()
-                    logging.info(f"📍 Location stored: {latitude}, {longitude} for {url}")
-        except Exception as e:
-            logging.error(f"❌ Failed to store location: {e}")
+            # Queue for the database; the INSERT is not on the critical path
+            # for the HTTP response, so batches are flushed in pipeline mode
+            self._pending_locations.append(
+                (device_id, latitude, longitude, accuracy, altitude, url, timestamp)
+            )
+            logger.info("📍 Location queued: %s, %s for %s", latitude, longitude, url)
 
-    def extract_youtube_video_id(self, url):
-        """Extract YouTube video ID from URL"""
-        try:
-            # Handle different YouTube URL formats:
-            # - https://www.youtube.com/watch?v=VIDEO_ID
-            # - https://youtu.be/VIDEO_ID
-            # - https://m.youtube.com/watch?v=VIDEO_ID
-            # - https://m.youtube.com/api/stats/watchtime?...&docid=VIDEO_ID (mobile)
+            now = time.monotonic()
+            if (len(self._pending_locations) >= self.LOCATION_BATCH_SIZE
+                    or now - self._last_location_flush >= self.LOCATION_FLUSH_INTERVAL_SECONDS):
+                self._flush_pending_locations()
+        except Exception as e:
+            logger.error("❌ Failed to store location: %s", e)
 
-            parsed = urlparse(url)
-            query_params = parse_qs(parsed.query)
+    def _flush_pending_locations(self):
+        """Write all queued location rows in one pipelined batch"""
+        if not self._pending_locations:
+            return
 
-            # Check for 'v' parameter (desktop/mobile watch page)
-            if 'v' in query_params:
-                return query_params['v'][0]
+        batch = list(self._pending_locations)
+        self._pending_locations.clear()
+        self._last_location_flush = time.monotonic()
 
-            # Check for 'docid' parameter (mobile API calls)
-            if 'docid' in query_params:
-                return query_params['docid'][0]
+        try:
+            with self.pool.connection() as conn:
+                # Pipeline mode sends the whole batch plus Sync in a single
+                # roundtrip instead of one roundtrip per INSERT
+                with conn.pipeline():
+                    with conn.cursor() as cursor:
+                        cursor.executemany(
+                            """INSERT INTO locations (device_id, latitude, longitude, accuracy, altitude, url, timestamp)
+                               VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                            batch
+                        )
+            logger.info("📍 Stored %s location(s) in one batch", len(batch))
+        except Exception as e:
+            logger.error("❌ Failed to store location batch: %s", e)
 
-            # Check for youtu.be short URL
-            if 'youtu.be/' in url:
-                return parsed.path.strip('/')
+    def extract_youtube_video_id(self, url):
+        """Extract YouTube video ID from URL
 
-            return None
-        except Exception as e:
-            logging.error(f"Error extracting video ID from {url}: {e}")
-            return None
+        Handles the different YouTube URL formats:
+        - https://www.youtube.com/watch?v=VIDEO_ID
+        - https://youtu.be/VIDEO_ID
+        - https://m.youtube.com/watch?v=VIDEO_ID
+        - https://m.youtube.com/api/stats/watchtime?...&docid=VIDEO_ID (mobile)
+        """
+        match = _YT_VIDEO_ID_RE.search(url)
+        if match:
+            return match.group(1) or match.group(2)
+        return None
 
     def get_channel_id_from_video(self, video_id):
-        """Get YouTube channel ID from video ID using YouTube Data API"""
-        # Check cache first
-        if video_id in self.video_to_channel_cache:
-            return self.video_to_channel_cache[video_id]
+        """Get YouTube channel ID from video ID using YouTube Data API.
+
+        Lookups run on a small thread pool; while one is in flight this
+        returns None, which keeps the filter fail-closed until the channel
+        is known. Failed lookups are negative-cached.
+        """
+        cached = self.video_to_channel_cache.get(video_id)
+        if isinstance(cached, Future):
+            if not cached.done():
+                return None  # Lookup still in flight
+            cached = cached.result()
+            self._cache_video_channel(video_id, cached)
+        if cached is _CHANNEL_LOOKUP_FAILED:
+            return None
+        if cached is not None:
+            return cached
 
         if not self.youtube_api_key:
-            logging.warning("YouTube API key not configured, cannot verify channel")
+            logger.warning("YouTube API key not configured, cannot verify channel")
             return None
 
+        future = self._yt_executor.submit(self._fetch_channel_id_from_api, video_id)
+        self._cache_video_channel(video_id, future)
+
+        # Give a fast API answer a short window so the very first request
+        # for a video can still be classified, but never stall the event
+        # loop for the full API timeout; later flows pick up the result
+        try:
+            result = future.result(timeout=1.0)
+        except FutureTimeoutError:
+            return None
+        self._cache_video_channel(video_id, result)
+        return None if result is _CHANNEL_LOOKUP_FAILED else result
+
+    def _cache_video_channel(self, video_id, value):
+        """Store a video -> channel entry, evicting the oldest at the cap"""
+        cache = self.video_to_channel_cache
+        if video_id not in cache and len(cache) >= self.VIDEO_CACHE_MAX:
+            del cache[next(iter(cache))]
+        cache[video_id] = value
+
+    def _fetch_channel_id_from_api(self, video_id):
+        """Blocking YouTube Data API lookup; runs on the executor threads"""
         try:
-            # Call YouTube Data API
-            api_url = f"https://www.googleapis.com/youtube/v3/videos"
+            api_url = "https://www.googleapis.com/youtube/v3/videos"
             params = {
                 'part': 'snippet',
                 'id': video_id,
                 'key': self.youtube_api_key
             }
 
-            response = requests.get(api_url, params=params, timeout=5)
+            response = self._yt_api_session.get(api_url, params=params, timeout=5)
 
             if response.status_code == 200:
                 data = response.json()
@@ -232,35 +641,37 @@ class Counter:
                     channel_id = data['items'][0]['snippet']['channelId']
                     channel_title = data['items'][0]['snippet']['channelTitle']
 
-                    # Cache the result
-                    self.video_to_channel_cache[video_id] = channel_id
-
-                    logging.info(f"📺 Video {video_id} belongs to channel: {channel_title} ({channel_id})")
+                    logger.info("📺 Video %s belongs to channel: %s (%s)", video_id, channel_title, channel_id)
                     return channel_id
             else:
-                logging.error(f"YouTube API error: {response.status_code}")
+                logger.error("YouTube API error: %s", response.status_code)
 
         except Exception as e:
-            logging.error(f"Error calling YouTube API: {e}")
+            logger.error("Error calling YouTube API: %s", e)
 
-        return None
+        return _CHANNEL_LOOKUP_FAILED
 
-    def is_youtube_video_allowed(self, url):
-        """Check if a YouTube video URL is allowed based on channel whitelist"""
-        video_id = self.extract_youtube_video_id(url)
+    def is_youtube_video_allowed(self, url, video_id=None):
+        """Check if a YouTube video URL is allowed based on channel whitelist
+
+        Callers that already hold the parsed video ID can pass it to skip
+        re-extracting it from the URL.
+        """
+        if video_id is None:
+            video_id = self.extract_youtube_video_id(url)
         if not video_id:
             return True  # Not a video URL, allow it
 
         channel_id = self.get_channel_id_from_video(video_id)
         if not channel_id:
-            logging.warning(f"⚠️  Could not determine channel for video {video_id}, BLOCKING by default")
+            logger.warning("⚠️  Could not determine channel for video %s, BLOCKING by default", video_id)
             return False
 
         if channel_id in self.allowed_youtube_channels:
-            logging.info(f"✅ ALLOWING video {video_id} (channel {channel_id} is whitelisted)")
+            logger.info("✅ ALLOWING video %s (channel %s is whitelisted)", video_id, channel_id)
             return True
         else:
-            logging.info(f"🚫 BLOCKING video {video_id} (channel {channel_id} not in whitelist)")
+            logger.info("🚫 BLOCKING video %s (channel %s not in whitelist)", video_id, channel_id)
             return False
 
     # Known captive portal detection URLs used by operating systems
@@ -273,26 +684,151 @@ class Counter:
         "nmcheck.gnome.org",
         "network-test.debian.org",
     ]
+    CAPTIVE_PORTAL_DETECTION_SET = frozenset(CAPTIVE_PORTAL_DETECTION_HOSTS)
+    # Subdomain matching mirrors the whitelist suffix handling: Windows
+    # probes via www.msftconnecttest.com while the list entry is bare
+    CAPTIVE_PORTAL_DETECTION_SUFFIXES = tuple(
+        '.' + host for host in CAPTIVE_PORTAL_DETECTION_HOSTS)
+
+    def _start_change_listener(self):
+        """Reload the whitelists when Postgres signals a change.
+
+        Triggers on the allowed_hosts / youtube_channels tables issue
+        NOTIFY allowed_hosts_changed, so the proxy only re-queries when the
+        data actually changed instead of polling. Runs on a dedicated
+        connection (LISTEN holds it open indefinitely) in a daemon thread
+        that reconnects with a backoff if the connection drops.
+        """
+        def listen():
+            while True:
+                try:
+                    with psycopg.connect(self.conn_string, autocommit=True) as conn:
+                        for channel in self.DB_NOTIFY_CHANNELS:
+                            conn.execute(f"LISTEN {channel}")
+                        logger.info("👂 Listening for whitelist changes on %s", ', '.join(self.DB_NOTIFY_CHANNELS))
+                        for _ in conn.notifies():
+                            logger.info("🔄 Whitelist change notification, reloading")
+                            self.load_allowed_hosts_from_db()
+                            self.load_allowed_youtube_channels_from_db()
+                            self._host_decision_cache.clear()
+                except Exception as e:
+                    logger.error("❌ Whitelist listener error: %s", e)
+                    time.sleep(5)  # Back off before reconnecting
 
-    def request(self, flow):
-        self.num = self.num + 1
-        logging.info("We've seen %d flows" % self.num)
-        logging.info(f"Request URL: {flow.request.host}")
+        threading.Thread(target=listen, name='whitelist-listener', daemon=True).start()
 
-        # Handle location tracking endpoint (intercept special path on any domain)
-        if flow.request.path == "/__track_location__" and flow.request.method == "POST":
-            logging.info(f"📍 Received location tracking request from {flow.request.host}")
-            try:
-                # Parse JSON body
-                data = json.loads(flow.request.content)
+    def _host_decision(self, full_host, base_domain):
+        """Classify a host against the whitelist, with a bounded cache.
 
-                latitude = data.get('latitude')
-                longitude = data.get('longitude')
-                url = data.get('url', 'unknown')
-                timestamp = data.get('timestamp')
-                accuracy = data.get('accuracy')
-                altitude = data.get('altitude')
-                device_id = data.get('device_id', 'iPhone')
+        A single page load hits the same handful of hosts hundreds of times
+        for CSS, JS, images and XHR; the classification only changes when
+        the whitelist reloads or a captive portal is auto-whitelisted, both
+        of which clear the cache. YouTube hosts cache as a separate decision
+        because the per-video channel check must still run per request.
+        """
+        decision = self._host_decision_cache.get(full_host)
+        if decision is not None:
+            return decision
+
+        # 1. Always allow captive portal detection URLs (critical for WiFi login)
+        if (full_host in self.CAPTIVE_PORTAL_DETECTION_SET
+                or full_host.endswith(self.CAPTIVE_PORTAL_DETECTION_SUFFIXES)):
+            logger.info("✅ Allowing captive portal detection URL: %s", full_host)
+            decision = self.DECISION_ALLOW
+
+        # 2. Allow auto-detected captive portals (critical for WiFi login)
+        # EXCLUDE youtube.com from auto-captive portal to allow channel filtering
+        # Not memoized: these entries expire, and a cached ALLOW would
+        # outlive the TTL
+        elif self._is_auto_whitelisted(base_domain) and base_domain != 'youtube.com':
+            logger.info("✅ Allowing auto-detected captive portal: %s", base_domain)
+            return self.DECISION_ALLOW
+
+        # 3. Allow essential hosts (Apple services - required for iPhone to function)
+        elif base_domain in self.ESSENTIAL_HOSTS_SET:
+            logger.info("✅ Allowing essential host: %s", base_domain)
+            decision = self.DECISION_ALLOW
+
+        # 4. Allow whitelisted domains and their subdomains
+        elif base_domain in self._allowed_set or full_host in self._allowed_set or full_host.endswith(self._allowed_suffixes):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("✅ Allowing whitelisted domain: %s (matches %s)",
+                            full_host, [a for a in self.ALLOWED_HOSTS if a in full_host])
+            if 'youtube.com' in full_host:
+                decision = self.DECISION_ALLOW_YOUTUBE_CHECK
+            else:
+                decision = self.DECISION_ALLOW
+
+        # 5. BLOCK everything else
+        else:
+            decision = self.DECISION_BLOCK
+
+        if len(self._host_decision_cache) >= self.HOST_DECISION_CACHE_MAX:
+            self._host_decision_cache.clear()
+        self._host_decision_cache[full_host] = decision
+        return decision
+
+    def _is_auto_whitelisted(self, domain):
+        """Check the captive-portal auto-whitelist, expiring stale entries"""
+        expires_at = self.auto_whitelisted_hosts.get(domain)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self.auto_whitelisted_hosts[domain]
+            return False
+        return True
+
+    def _auto_whitelist(self, domain):
+        """Auto-whitelist a detected captive portal and drop stale decisions"""
+        self.auto_whitelisted_hosts[domain] = time.monotonic() + self.AUTO_WHITELIST_TTL_SECONDS
+        if len(self.auto_whitelisted_hosts) > self.AUTO_WHITELIST_MAX:
+            del self.auto_whitelisted_hosts[next(iter(self.auto_whitelisted_hosts))]
+        self._host_decision_cache.clear()
+
+    def request(self, flow):
+        # Bind the request attributes we touch repeatedly to locals;
+        # flow.request.X goes through descriptor machinery on every access
+        req = flow.request
+        host = req.host
+        path = req.path
+
+        # CONNECT is just TLS tunnel setup; the decrypted inner flows come
+        # back through this hook with their real method and host, so running
+        # the whole whitelist pipeline here would do everything twice per
+        # HTTPS request
+        if req.method == "CONNECT":
+            return
+
+        self.num = self.num + 1
+        logger.info("We've seen %d flows", self.num)
+        logger.info("Request URL: %s", host)
+
+        # Serve the tracking script itself (intercepted on any domain)
+        if path == TRACKER_SCRIPT_PATH:
+            flow.response = http.Response.make(
+                200,
+                _TRACKER_JS_BYTES,
+                {
+                    "Content-Type": "application/javascript",
+                    "Cache-Control": "public, max-age=3600, immutable",
+                },
+            )
+            return
+
+        # Handle location tracking endpoint (intercept special path on any domain)
+        if path == "/__track_location__" and req.method == "POST":
+            logger.info("📍 Received location tracking request from %s", host)
+            try:
+                # Parse JSON body
+                data = json.loads(req.content)
+
+                latitude = data.get('latitude')
+                longitude = data.get('longitude')
+                url = data.get('url', 'unknown')
+                timestamp = data.get('timestamp')
+                accuracy = data.get('accuracy')
+                altitude = data.get('altitude')
+                device_id = data.get('device_id', 'iPhone')
 
                 # Store in database (this also updates self.currently_at_blocked_location)
                 self.store_location(latitude, longitude, url, timestamp, accuracy, altitude, device_id)
@@ -306,74 +842,7 @@ class Counter:
                 # If blocked, include the block page HTML
                 if self.currently_at_blocked_location:
                     blocked_location_name = self.current_blocked_location_name or "a blocked location"
-                    response_data["block_page"] = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Browsing Blocked</title>
-    <style>
-        body {{
-            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            margin: 0;
-            padding: 20px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            min-height: 100vh;
-        }}
-        .container {{
-            background: white;
-            border-radius: 20px;
-            padding: 40px;
-            max-width: 500px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            text-align: center;
-        }}
-        .emoji {{
-            font-size: 80px;
-            margin-bottom: 20px;
-        }}
-        h1 {{
-            color: #333;
-            margin: 0 0 10px 0;
-            font-size: 28px;
-        }}
-        .location {{
-            color: #666;
-            font-size: 16px;
-            margin: 10px 0 20px 0;
-        }}
-        p {{
-            color: #666;
-            line-height: 1.6;
-            margin: 20px 0;
-        }}
-        .note {{
-            background: #f0f0f0;
-            padding: 15px;
-            border-radius: 10px;
-            font-size: 14px;
-            margin-top: 20px;
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="emoji">🚫</div>
-        <h1>Browsing Blocked</h1>
-        <div class="location">📍 {blocked_location_name}</div>
-        <p>You are currently at a blocked location. Internet browsing is not allowed at this location.</p>
-        <p>To browse websites, please move to a different location.</p>
-        <div class="note">
-            <strong>Note:</strong> Essential services (Apple, iCloud) remain accessible.
-        </div>
-    </div>
-</body>
-</html>
-"""
+                    response_data["block_page"] = _location_block_page_html(blocked_location_name)
 
                 # Return response (intercepted, never forwarded to real server)
                 flow.response = http.Response.make(
@@ -383,7 +852,7 @@ class Counter:
                 )
                 return
             except Exception as e:
-                logging.error(f"❌ Error processing location: {e}")
+                logger.error("❌ Error processing location: %s", e)
                 flow.response = http.Response.make(
                     400,
                     b'{"status": "error"}',
@@ -391,166 +860,46 @@ class Counter:
                 )
                 return
 
-        full_host = flow.request.host
+        full_host = host
 
         # Location-based blocking: Block all browsing if at blocked location
         # Always allow essential hosts (Apple services) regardless of location
-        extracted_for_essential = tldextract.extract(full_host)
-        base_domain_for_essential = f"{extracted_for_essential.domain}.{extracted_for_essential.suffix}"
-        is_essential_host = any(essential_host in base_domain_for_essential for essential_host in self.ESSENTIAL_HOSTS)
+        base_domain_for_essential = _base_domain(full_host)
+        is_essential_host = base_domain_for_essential in self.ESSENTIAL_HOSTS_SET
 
         if self.currently_at_blocked_location and not is_essential_host:
             blocked_location_name = self.current_blocked_location_name or "a blocked location"
-            logging.warning(f"🚫 BLOCKED - You are at {blocked_location_name}. Browsing not allowed at this location.")
+            logger.warning("🚫 BLOCKED - You are at %s. Browsing not allowed at this location.", blocked_location_name)
             flow.response = http.Response.make(
                 403,
-                f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Browsing Blocked</title>
-    <style>
-        body {{
-            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            margin: 0;
-            padding: 20px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            min-height: 100vh;
-        }}
-        .container {{
-            background: white;
-            border-radius: 20px;
-            padding: 40px;
-            max-width: 500px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            text-align: center;
-        }}
-        .emoji {{
-            font-size: 80px;
-            margin-bottom: 20px;
-        }}
-        h1 {{
-            color: #333;
-            margin: 0 0 10px 0;
-            font-size: 28px;
-        }}
-        .location {{
-            color: #666;
-            font-size: 16px;
-            margin: 10px 0 20px 0;
-        }}
-        p {{
-            color: #666;
-            line-height: 1.6;
-            margin: 20px 0;
-        }}
-        .note {{
-            background: #f0f0f0;
-            padding: 15px;
-            border-radius: 10px;
-            font-size: 14px;
-            margin-top: 20px;
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="emoji">🚫</div>
-        <h1>Browsing Blocked</h1>
-        <div class="location">📍 {blocked_location_name}</div>
-        <p>You are currently at a blocked location. Internet browsing is not allowed at this location.</p>
-        <p>To browse websites, please move to a different location.</p>
-        <div class="note">
-            <strong>Note:</strong> Essential services (Apple, iCloud) remain accessible.
-        </div>
-    </div>
-</body>
-</html>""".encode('utf-8'),
+                _location_block_page_html(blocked_location_name).encode('utf-8'),
                 {"Content-Type": "text/html; charset=utf-8"}
             )
             return
 
         # Check if host is an IP address
-        import ipaddress
-        is_ip = False
-        try:
-            ipaddress.ip_address(full_host.split(':')[0])  # Remove port if present
-            is_ip = True
-        except ValueError:
-            pass
-
-        if is_ip:
+        if _is_ip_host(full_host):
             # For IP addresses, try to get the SNI hostname for whitelist checking
             sni_host = flow.client_conn.sni if hasattr(flow.client_conn, 'sni') and flow.client_conn.sni else None
             if sni_host:
                 # Use SNI hostname for whitelist checking
                 full_host = sni_host
-                extracted = tldextract.extract(sni_host)
-                base_domain = f"{extracted.domain}.{extracted.suffix}"
-                logging.info(f"Direct IP connection to {full_host.split(':')[0]} (SNI: {sni_host}, base: {base_domain})")
+                base_domain = _base_domain(sni_host)
+                logger.info("Direct IP connection to %s (SNI: %s, base: %s)", full_host.split(':')[0], sni_host, base_domain)
             else:
                 # No SNI, use IP address
                 base_domain = full_host.split(':')[0]
-                logging.info(f"Direct IP connection: {base_domain} (no SNI)")
+                logger.info("Direct IP connection: %s (no SNI)", base_domain)
         else:
             # For domain names, extract base domain
-            extracted = tldextract.extract(full_host)
-            base_domain = f"{extracted.domain}.{extracted.suffix}"
-            logging.info(f"base domain {base_domain}")
+            base_domain = _base_domain(full_host)
+            logger.info("base domain %s", base_domain)
 
         # WHITELIST MODE: Only allow specific domains, block everything else
+        decision = self._host_decision(full_host, base_domain)
 
-        # 1. Always allow captive portal detection URLs (critical for WiFi login)
-        if any(detection_host in full_host for detection_host in self.CAPTIVE_PORTAL_DETECTION_HOSTS):
-            logging.info(f"✅ Allowing captive portal detection URL: {full_host}")
-            pass  # Let request go through naturally
-
-        # 2. Allow auto-detected captive portals (critical for WiFi login)
-        # EXCLUDE youtube.com from auto-captive portal to allow channel filtering
-        elif base_domain in self.auto_whitelisted_hosts and base_domain != 'youtube.com':
-            logging.info(f"✅ Allowing auto-detected captive portal: {base_domain}")
-            pass  # Let request go through naturally
-
-        # 3. Allow essential hosts (Apple services - required for iPhone to function)
-        elif base_domain in self.ESSENTIAL_HOSTS:
-            logging.info(f"✅ Allowing essential host: {base_domain}")
-            pass  # Let request go through naturally
-
-        # 4. Allow whitelisted domains and related subdomains
-        # Check if any allowed domain is part of the current domain (e.g., images-amazon.com contains "amazon")
-        elif any(allowed in full_host for allowed in self.ALLOWED_HOSTS):
-            # Special handling for YouTube: check channel whitelist if enabled
-            if self.youtube_filter_enabled and 'youtube.com' in full_host:
-                # Build full URL properly
-                full_url = f"{flow.request.scheme}://{flow.request.host}{flow.request.path}"
-                if flow.request.query:
-                    # Convert query MultiDict to proper query string
-                    from urllib.parse import urlencode
-                    query_string = urlencode(flow.request.query.fields)
-                    full_url += f"?{query_string}"
-
-                logging.info(f"🔍 Checking YouTube URL: {full_url}")
-
-                # Check if this is a video URL and if it's allowed
-                if not self.is_youtube_video_allowed(full_url):
-                    logging.info(f"🚫 BLOCKING YouTube video (channel not whitelisted)")
-                    flow.response = http.Response.make(
-                        403,
-                        b"Access denied: This YouTube channel is not allowed",
-                        {"Content-Type": "text/plain"}
-                    )
-                    return
-
-            logging.info(f"✅ Allowing whitelisted domain: {full_host} (matches {[a for a in self.ALLOWED_HOSTS if a in full_host]})")
-            pass  # Let request go through naturally
-
-        # 5. BLOCK everything else
-        else:
-            logging.info(f"🚫 BLOCKING non-whitelisted domain: {base_domain}")
+        if decision == self.DECISION_BLOCK:
+            logger.info("🚫 BLOCKING non-whitelisted domain: %s", base_domain)
 
             flow.response = http.Response.make(
                 403,  # Forbidden status code
@@ -559,212 +908,130 @@ class Counter:
             )
             return
 
+        # Special handling for YouTube: check channel whitelist if enabled
+        if decision == self.DECISION_ALLOW_YOUTUBE_CHECK and self.youtube_filter_enabled:
+            # mitmproxy has already parsed the query, so grab the video
+            # ID straight from it; req.url covers the remaining shapes
+            # without re-serializing the query string by hand
+            video_id = req.query.get('v') or req.query.get('docid')
+
+            logger.info("🔍 Checking YouTube URL: %s", req.url)
+
+            # Check if this is a video URL and if it's allowed
+            if not self.is_youtube_video_allowed(req.url, video_id=video_id):
+                logger.info("🚫 BLOCKING YouTube video (channel not whitelisted)")
+                flow.response = http.Response.make(
+                    403,
+                    b"Access denied: This YouTube channel is not allowed",
+                    {"Content-Type": "text/plain"}
+                )
+                return
+
+        # Allowed: let the request go through naturally
+
     def response(self, flow):
         """Detect captive portals by analyzing redirects and inject location tracking"""
-        if not flow.response:
+        resp = flow.response
+        if not resp:
             return
 
-        # Inject location tracking JavaScript into HTML responses
-        content_type = flow.response.headers.get("content-type", "")
-        if "text/html" in content_type and flow.response.status_code == 200:
-            try:
-                # JavaScript to capture and send location with permission enforcement
-                location_script = """
-<style>
-#location-permission-overlay {
-    position: fixed;
-    top: 0;
-    left: 0;
-    width: 100%;
-    height: 100%;
-    background: rgba(0, 0, 0, 0.95);
-    z-index: 999999;
-    display: flex;
-    align-items: center;
-    justify-content: center;
-    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-}
-#location-permission-content {
-    background: white;
-    border-radius: 20px;
-    padding: 40px;
-    max-width: 500px;
-    text-align: center;
-    box-shadow: 0 20px 60px rgba(0,0,0,0.5);
-}
-#location-permission-content .icon {
-    font-size: 60px;
-    margin-bottom: 20px;
-}
-#location-permission-content h2 {
-    color: #333;
-    margin: 0 0 15px 0;
-}
-#location-permission-content p {
-    color: #666;
-    line-height: 1.6;
-    margin: 15px 0;
-}
-#location-permission-content .spinner {
-    border: 4px solid #f3f3f3;
-    border-top: 4px solid #667eea;
-    border-radius: 50%;
-    width: 40px;
-    height: 40px;
-    animation: spin 1s linear infinite;
-    margin: 20px auto;
-}
-@keyframes spin {
-    0% { transform: rotate(0deg); }
-    100% { transform: rotate(360deg); }
-}
-#location-permission-content .error {
-    color: #d93025;
-    font-weight: 600;
-}
-</style>
-<div id="location-permission-overlay">
-    <div id="location-permission-content">
-        <div class="icon">📍</div>
-        <h2>Location Required</h2>
-        <p>This site requires location permission to verify access.</p>
-        <div class="spinner"></div>
-        <p id="location-status">Waiting for permission...</p>
-    </div>
-</div>
-<script>
-(function() {
-    var overlay = document.getElementById('location-permission-overlay');
-    var status = document.getElementById('location-status');
-
-    function hideOverlay() {
-        if (overlay) {
-            overlay.style.display = 'none';
-        }
-    }
+        # Fast exit for the bulk of traffic: only HTML bodies get the
+        # tracking script, and only redirects / 511s feed captive portal
+        # detection - images, CSS, JS and API responses need neither
+        status_code = resp.status_code
+        content_type = resp.headers.get("content-type", "")
+        is_html = "text/html" in content_type
+        if not is_html and status_code not in (301, 302, 303, 307) and status_code not in CAPTIVE_STATUSES:
+            return
 
-    function showError(message) {
-        status.innerHTML = '<span class="error">' + message + '</span>';
-        document.querySelector('.spinner').style.display = 'none';
-    }
+        request_host = flow.request.host
 
-    if (navigator.geolocation) {
-        navigator.geolocation.getCurrentPosition(function(position) {
-            status.textContent = 'Verifying location...';
-            var data = {
-                latitude: position.coords.latitude,
-                longitude: position.coords.longitude,
-                accuracy: position.coords.accuracy,
-                altitude: position.coords.altitude,
-                url: window.location.href,
-                timestamp: new Date().toISOString(),
-                device_id: 'iPhone'
-            };
-            fetch('/__track_location__', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify(data)
-            }).then(function(response) {
-                return response.json();
-            }).then(function(json) {
-                if (json.blocked) {
-                    // At blocked location - replace page with block message
-                    document.body.innerHTML = json.block_page;
-                } else {
-                    // Not at blocked location - hide overlay and show page
-                    hideOverlay();
-                }
-            }).catch(function(err) {
-                // Network error - allow page to show (fail open)
-                hideOverlay();
-            });
-        }, function(error) {
-            if (error.code === 1) {
-                showError('⚠️ Location permission denied.<br><br>You must grant location permission to browse websites.<br><br>Please refresh and allow location access.');
-            } else if (error.code === 2) {
-                showError('⚠️ Location unavailable.<br><br>Unable to determine your location. Please check your device settings.');
-            } else {
-                showError('⚠️ Location request timed out.<br><br>Please refresh the page to try again.');
-            }
-        }, {
-            enableHighAccuracy: true,
-            timeout: 10000,
-            maximumAge: 0
-        });
-    } else {
-        showError('⚠️ Geolocation not supported.<br><br>Your browser does not support location services.');
-    }
-})();
-</script>
-"""
-                # Decode response (handles gzip/brotli automatically)
-                # Work with text to avoid issues with compressed content
-                html = flow.response.text
-
-                # Inject before </body> or </html> tag
-                if "</body>" in html:
-                    html = html.replace("</body>", location_script + "</body>")
-                elif "</html>" in html:
-                    html = html.replace("</html>", location_script + "</html>")
-                else:
-                    # If no closing tags, append at the end
-                    html += location_script
-
-                # Set the modified text back (mitmproxy handles encoding automatically)
-                flow.response.text = html
+        # Inject location tracking JavaScript into HTML responses
+        if is_html and status_code == 200:
+            try:
+                # flow.response.content is the decoded body as bytes; staying
+                # at the bytes level skips the str decode + re-encode that
+                # flow.response.text would cost on every HTML page
+                content = resp.content
+                if (content
+                        and len(content) <= MAX_INJECTION_BODY_BYTES
+                        and b"<html" in content[:512].lower()):
+                    # Closing tags live at the end of the document, so only
+                    # search the tail instead of scanning the whole body
+                    tail_start = max(0, len(content) - INJECTION_TAIL_SEARCH_BYTES)
+                    index = content.rfind(b"</body>", tail_start)
+                    if index < 0:
+                        index = content.rfind(b"</html>", tail_start)
+                    if index >= 0:
+                        resp.content = (
+                            content[:index]
+                            + _LOCATION_OVERLAY_HTML_BYTES
+                            + content[index:]
+                        )
+                    else:
+                        # No closing tags, append at the end
+                        resp.content = content + _LOCATION_OVERLAY_HTML_BYTES
 
             except Exception as e:
-                logging.error(f"❌ Error injecting location script: {e}")
+                logger.error("❌ Error injecting location script: %s", e)
+
+        # Both captive-detection branches below key off the base domain of
+        # the original request; compute it once for whichever branch runs
+        if status_code in (302, 307, 303, 301) or status_code in CAPTIVE_STATUSES:
+            request_base_domain = _base_domain(request_host)
 
         # Check for HTTP redirects (302, 307, etc.)
-        if flow.response.status_code in [302, 307, 303, 301]:
-            location = flow.response.headers.get("Location", "")
+        if status_code in (302, 307, 303, 301):
+            location = resp.headers.get("Location", "")
             if location:
                 # Extract the redirect destination domain
                 try:
-                    # Handle both absolute and relative URLs
+                    # Handle both absolute and relative URLs; relative
+                    # redirects stay on the current host and can never be a
+                    # cross-domain hop, so neither base-domain lookup runs
+                    redirect_host = None
                     if location.startswith("http"):
-                        from urllib.parse import urlparse
                         parsed = urlparse(location)
-                        redirect_host = parsed.netloc
-                    else:
-                        # Relative redirect, use current host
-                        redirect_host = flow.request.host
+                        if parsed.netloc != request_host:
+                            redirect_host = parsed.netloc
 
-                    # Extract base domain
-                    extracted = tldextract.extract(redirect_host)
-                    redirect_base_domain = f"{extracted.domain}.{extracted.suffix}"
+                    redirect_base_domain = _base_domain(redirect_host) if redirect_host else None
 
-                    # Extract original request domain
-                    orig_extracted = tldextract.extract(flow.request.host)
-                    orig_base_domain = f"{orig_extracted.domain}.{orig_extracted.suffix}"
-
-                    # If redirecting to a different domain, it might be a captive portal
-                    if redirect_base_domain != orig_base_domain:
+                    # If redirecting to a different domain, it might be a
+                    # captive portal; domains already auto-whitelisted need
+                    # no further evidence, so skip the tracking work
+                    if (redirect_base_domain is not None
+                            and redirect_base_domain != request_base_domain
+                            and not self._is_auto_whitelisted(redirect_base_domain)):
                         # Check if the original request was to a captive portal detection URL
-                        if any(detection_host in flow.request.host for detection_host in self.CAPTIVE_PORTAL_DETECTION_HOSTS):
-                            logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {redirect_base_domain} (from detection URL)")
-                            self.auto_whitelisted_hosts.add(redirect_base_domain)
+                        if (request_host in self.CAPTIVE_PORTAL_DETECTION_SET
+                                or request_host.endswith(self.CAPTIVE_PORTAL_DETECTION_SUFFIXES)):
+                            logger.info("🌐 CAPTIVE PORTAL DETECTED: %s (from detection URL)", redirect_base_domain)
+                            self._auto_whitelist(redirect_base_domain)
                         else:
                             # Track suspicious redirects
-                            if redirect_base_domain not in self.redirect_tracker:
-                                self.redirect_tracker[redirect_base_domain] = set()
-                            self.redirect_tracker[redirect_base_domain].add(orig_base_domain)
+                            now = time.monotonic()
+                            entry = self.redirect_tracker.get(redirect_base_domain)
+                            if entry is None or entry[0] < now:
+                                entry = (now + self.REDIRECT_TRACKER_TTL_SECONDS, set())
+                                self.redirect_tracker[redirect_base_domain] = entry
+                                if len(self.redirect_tracker) > self.REDIRECT_TRACKER_MAX:
+                                    self.redirect_tracker.popitem(last=False)
+                            destinations = entry[1]
+                            destinations.add(request_base_domain)
 
                             # If the same domain redirects multiple different destinations, it's likely a captive portal
-                            if len(self.redirect_tracker[redirect_base_domain]) >= 2:
-                                logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {redirect_base_domain} (multiple redirects)")
-                                self.auto_whitelisted_hosts.add(redirect_base_domain)
+                            if len(destinations) >= 2:
+                                logger.info("🌐 CAPTIVE PORTAL DETECTED: %s (multiple redirects)", redirect_base_domain)
+                                self._auto_whitelist(redirect_base_domain)
 
                 except Exception as e:
-                    logging.error(f"Error parsing redirect: {e}")
+                    logger.error("Error parsing redirect: %s", e)
 
         # Check for captive portal specific status code
-        if flow.response.status_code == 511:  # Network Authentication Required
-            extracted = tldextract.extract(flow.request.host)
-            base_domain = f"{extracted.domain}.{extracted.suffix}"
-            logging.info(f"🌐 CAPTIVE PORTAL DETECTED: {base_domain} (511 status)")
-            self.auto_whitelisted_hosts.add(base_domain)
+        if status_code in CAPTIVE_STATUSES:  # 511 Network Authentication Required
+            logger.info("🌐 CAPTIVE PORTAL DETECTED: %s (511 status)", request_base_domain)
+            self._auto_whitelist(request_base_domain)
 
     def load(self, loader):
         # Load allowed hosts from PostgreSQL database
@@ -773,28 +1040,44 @@ class Counter:
         # Load allowed YouTube channels from PostgreSQL database
         self.load_allowed_youtube_channels_from_db()
 
-        # Load default ignore hosts from a file
-        #default_ignore_hosts = self.load_ignore_hosts_from_file("ignore_hosts.txt")
+        # Reload both on database change notifications
+        self._start_change_listener()
+
+        # Compile the ignore-hosts patterns once at load time
+        self.load_ignore_hosts_from_file("ignore_hosts.txt")
 
-        # Load default ignore hosts from a file
         loader.add_option(
             name="block_global",
             typespec=bool,
             default=False,
             help="Disable block global option",
         )
-    # def load_ignore_hosts_from_file(self, file_path):
-    #     """
-    #     Load ignore hosts from the specified file and return them as a space-separated string.
-    #     """
-    #     try:
-    #         with open(file_path, "r") as file:
-    #             domains = [line.strip() for line in file if line.strip()]
-    #             ctx.log.info(f"Loaded ignore hosts from {file_path}: {domains}")
-    #             self.ignore_hosts_patterns = [re.compile(pattern) for pattern in domains]
-    #             return " ".join(domains)
-    #     except FileNotFoundError:
-    #         ctx.log.warning(f"Ignore hosts file not found: {file_path}. Using default patterns.")
-    #         self.ignore_hosts_patterns = [re.compile(pattern) for pattern in ["icloud.com", "apple.com", "mzstatic.com"]]
-    #         return "icloud.com apple.com mzstatic.com"
-addons = [Counter()]
\ No newline at end of file
+    def load_ignore_hosts_from_file(self, file_path):
+        """
+        Load ignore hosts from the specified file and return them as a space-separated string.
+
+        The patterns are merged into one alternation compiled once at load
+        time, so a host check is a single regex scan instead of a loop over
+        individually compiled patterns.
+        """
+        try:
+            with open(file_path, "r") as file:
+                patterns = [line.strip() for line in file if line.strip()]
+            logger.info("Loaded ignore hosts from %s: %s", file_path, patterns)
+        except FileNotFoundError:
+            logger.warning("Ignore hosts file not found: %s. Using default patterns.", file_path)
+            patterns = ["icloud.com", "apple.com", "mzstatic.com"]
+        self.ignore_hosts_re = re.compile("(?:" + "|".join(patterns) + ")")
+        return " ".join(patterns)
+# Reuse a single Counter instance: constructing one is expensive (connection
+# pool, listener thread, precomputed geofence tables) and a second instance
+# would also fork the decision and video caches
+_addon_instance = None
+
+def _get_addon():
+    global _addon_instance
+    if _addon_instance is None:
+        _addon_instance = Counter()
+    return _addon_instance
+
+addons = [_get_addon()]
\ No newline at end of file